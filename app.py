@@ -1,16 +1,211 @@
 import os
-from flask import Flask, request, abort, jsonify
+from flask import Flask, request, abort, jsonify, current_app
 from flask_sqlalchemy import SQLAlchemy
 from flask_cors import CORS
 
-from auth import AuthError, requires_auth
+from auth import AuthError, check_permissions, requires_auth
+from caching import conditional, get_cache, init_cache
+from compression import init_compression
+from dbpool import pool_status
+from instrumentation import init_instrumentation, render_metrics
+from profiling import PROFILE_MODES, init_profiling, render
+from listing import (embed_related, fetch_all, paginate, select_columns,
+                     stream_format, stream_rows, wants_all)
 from models import *
+from sqlalchemy.orm import selectinload
+from replicas import get_replicas, read_only
+from search import search_catalogue
+from serialization import init_serialization
+from stats import catalogue_stats, init_stats
+
+MAX_BATCH_SIZE = int(os.environ.get('MAX_BATCH_SIZE', 1000))
+
+
+'''
+unprocessable_entity(message, results=None)
+    the 422 error body with a specific message (and per-item results)
+'''
+
+
+def unprocessable_entity(message, results=None):
+    body = {
+        'success': False,
+        'error': 422,
+        'message': message
+    }
+    if results is not None:
+        body['results'] = results
+    return jsonify(body), 422
+
+
+'''
+create_batch(model, key, items)
+    validates every item before touching the database, any invalid item
+    rejects the whole batch with a 422 listing the failures by index
+    valid batches are written with bulk_insert in one transaction
+    return one result per item with its new id
+'''
+
+
+def create_batch(model, key, items):
+    max_batch_size = current_app.config['MAX_BATCH_SIZE']
+    if not items or len(items) > max_batch_size:
+        return unprocessable_entity(
+            f'batch must hold 1 to {max_batch_size} items')
+
+    rows = []
+    errors = []
+    for index, item in enumerate(items):
+        try:
+            rows.append(model.validate(item))
+        except ValueError as e:
+            errors.append({'index': index, 'success': False,
+                           'message': str(e)})
+    if errors:
+        return unprocessable_entity('unprocessable', results=errors)
+
+    try:
+        ids = bulk_insert(model, rows)
+    except Exception:
+        db.session.rollback()
+        abort(422)
+
+    return jsonify({
+        'success': True,
+        key: [dict(row, id=id) for row, id in zip(rows, ids)],
+        'results': [{'index': index, 'success': True, 'id': id}
+                    for index, id in enumerate(ids)]
+    })
+
+
+'''
+parse_bulk_target(model, body)
+    reads the rows a bulk PATCH / DELETE applies to: {"ids": [...]} and / or
+    {"filter": {column: value}} (equality on the model's fields)
+    raises ValueError when neither is given or either is malformed
+'''
+
+
+def parse_bulk_target(model, body):
+    if not isinstance(body, dict):
+        raise ValueError('body must be an object')
+
+    ids = body.get('ids')
+    criteria = body.get('filter')
+    if ids is None and criteria is None:
+        raise ValueError('ids or filter is required')
+
+    if ids is not None:
+        if (not isinstance(ids, list) or not ids
+                or not all(type(id) is int for id in ids)):
+            raise ValueError('ids must be a list of integers')
+        if len(ids) > current_app.config['MAX_BATCH_SIZE']:
+            raise ValueError('too many ids')
+
+    if criteria is not None:
+        criteria = model.validate(criteria, partial=True)
+        if not criteria:
+            raise ValueError('filter must not be empty')
+
+    return ids, criteria
+
+
+'''
+update_bulk(model, body)
+    {"ids" / "filter": ..., "changes": {...}} applied as one set based UPDATE
+    return the ids of the updated rows
+'''
+
+
+def update_bulk(model, body):
+    try:
+        ids, criteria = parse_bulk_target(model, body)
+        changes = model.validate(body.get('changes'), partial=True)
+        if not changes:
+            raise ValueError('changes must not be empty')
+    except ValueError as e:
+        return unprocessable_entity(str(e))
+
+    try:
+        updated = bulk_update(model, changes, ids=ids, criteria=criteria)
+    except Exception:
+        db.session.rollback()
+        abort(422)
+
+    return jsonify({
+        'success': True,
+        'updated': updated
+    })
+
+
+'''
+delete_bulk(model, body)
+    {"ids" / "filter": ...} removed with one set based DELETE, the ids can
+    also be passed as ?ids=1,2,3 for clients that cannot send a body
+    return the ids of the deleted rows
+'''
+
+
+def delete_bulk(model, body):
+    if body is None and request.args.get('ids'):
+        try:
+            body = {'ids': [int(id) for id in request.args['ids'].split(',')]}
+        except ValueError:
+            return unprocessable_entity('ids must be a list of integers')
+
+    try:
+        ids, criteria = parse_bulk_target(model, body)
+    except ValueError as e:
+        return unprocessable_entity(str(e))
+
+    try:
+        deleted = bulk_delete(model, ids=ids, criteria=criteria)
+    except Exception:
+        db.session.rollback()
+        abort(422)
+
+    return jsonify({
+        'success': True,
+        'deleted': deleted
+    })
+
+
+'''
+profile_config()
+    the runtime profiling settings of this worker
+'''
+
+
+def profile_config():
+    return {
+        'enabled': current_app.config['PROFILE_ENABLED'],
+        'sample_rate': current_app.config['PROFILE_SAMPLE_RATE'],
+        'mode': current_app.config['PROFILE_MODE']
+    }
+
+
+'''
+create_app(test_config=None)
+    builds the app without touching the database, so importing this module
+    (gunicorn app:app) is cheap; see setup_db for DB_STARTUP_MODE
+    test_config is applied over the defaults, e.g.
+    {'SQLALCHEMY_DATABASE_URI': ..., 'DB_STARTUP_MODE': 'create'}
+'''
 
 
 def create_app(test_config=None):
 
     app = Flask(__name__)
+    if test_config is not None:
+        app.config.from_mapping(test_config)
+    app.config.setdefault('MAX_BATCH_SIZE', MAX_BATCH_SIZE)
     setup_db(app)
+    init_cache(app)
+    init_stats(app)
+    init_serialization(app)
+    init_instrumentation(app)
+    init_profiling(app)
+    init_compression(app)
     CORS(app)
 
     # Use the after_request decorator to set Access-Control-Allow
@@ -29,16 +224,45 @@ def create_app(test_config=None):
     '''
   @ implement endpoint
     GET /actors
+    paginated by ?limit= and the opaque ?after= cursor, ?all=true returns
+    every actor in one response
+    ?stream=json or ?stream=ndjson streams every actor in constant memory
+    ?fields=name,age limits the columns read and returned (id is always
+    included)
+    ?name=, ?gender=, ?min_age=, ?max_age= filter and ?sort=age / ?sort=-age
+    orders the listing (see listing.FILTERS)
+    ?embed=movies nests each actor's filmography
+    answers If-None-Match / If-Modified-Since with 304 while the actors
+    table is unchanged, and repeats are served from the response cache
   '''
     @app.route('/actors')
     @requires_auth('get:actors')
+    @read_only
+    @conditional('actors', cache=True,
+                 embeds={'movies': ('castings', 'movies')})
     def get_actors(token):
-        actors = Actor.query.order_by(Actor.id).all()
+        table = Actor.__table__
+        columns = select_columns(table, request.args)
+        if request.args.get('embed'):
+            check_permissions('get:movies', token)
+
+        fmt = stream_format(request.args)
+        if fmt:
+            return stream_rows(table, columns, request.args, 'actors',
+                               fmt)
+
+        if wants_all(request.args):
+            actors = fetch_all(table, columns, request.args)
+            next_cursor = None
+        else:
+            actors, next_cursor = paginate(table, columns, request.args)
+        embed_related(table, actors, request.args)
 
         try:
             return jsonify({
                 'success': True,
-                'actors': [actor.format() for actor in actors]
+                'actors': actors,
+                'next_cursor': next_cursor
             })
         except Exception:
             abort(404)
@@ -46,43 +270,258 @@ def create_app(test_config=None):
     '''
   @ implement endpoint
     GET /movies
+    paginated like GET /actors, filtered by ?title=, ?released_after= and
+    ?released_before=, ?embed=cast nests each movie's cast
   '''
     @app.route('/movies')
     @requires_auth('get:movies')
+    @read_only
+    @conditional('movies', cache=True,
+                 embeds={'cast': ('castings', 'actors')})
     def get_movies(token):
-
-        movies = Movie.query.order_by(Movie.id).all()
+        table = Movie.__table__
+        columns = select_columns(table, request.args)
+        if request.args.get('embed'):
+            check_permissions('get:actors', token)
+
+        fmt = stream_format(request.args)
+        if fmt:
+            return stream_rows(table, columns, request.args, 'movies',
+                               fmt)
+
+        if wants_all(request.args):
+            movies = fetch_all(table, columns, request.args)
+            next_cursor = None
+        else:
+            movies, next_cursor = paginate(table, columns, request.args)
+        embed_related(table, movies, request.args)
 
         try:
             return jsonify({
                 'success': True,
-                'movies': [movie.format() for movie in movies]
+                'movies': movies,
+                'next_cursor': next_cursor
             })
         except Exception:
             abort(404)
 
+    '''
+  @ implement endpoint
+    GET /movies/<id>/actors
+    the movie and its cast, loaded with selectinload (two queries)
+  '''
+    @app.route('/movies/<int:id>/actors')
+    @requires_auth(all_of=['get:movies', 'get:actors'])
+    @read_only
+    @conditional('movies', 'castings', 'actors')
+    def get_movie_cast(token, id):
+        movie = Movie.query.options(selectinload(Movie.cast)) \
+            .filter(Movie.id == id).one_or_none()
+        if movie is None:
+            abort(404)
+
+        return jsonify({
+            'success': True,
+            'movie': movie.format(),
+            'actors': [actor.format() for actor in movie.cast]
+        })
+
+    '''
+  @ implement endpoint
+    GET /actors/<id>/movies
+    the actor and their filmography, loaded with selectinload
+  '''
+    @app.route('/actors/<int:id>/movies')
+    @requires_auth(all_of=['get:actors', 'get:movies'])
+    @read_only
+    @conditional('actors', 'castings', 'movies')
+    def get_actor_movies(token, id):
+        actor = Actor.query.options(selectinload(Actor.movies)) \
+            .filter(Actor.id == id).one_or_none()
+        if actor is None:
+            abort(404)
+
+        return jsonify({
+            'success': True,
+            'actor': actor.format(),
+            'movies': [movie.format() for movie in actor.movies]
+        })
+
+    '''
+  @ implement endpoint
+    GET /search
+    ranked full text and prefix search over actor names and movie titles,
+    see search.search_catalogue
+  '''
+    @app.route('/search')
+    @requires_auth(any_of=['get:actors', 'get:movies'])
+    @read_only
+    @conditional('actors', 'movies', cache=True)
+    def search(token):
+        return jsonify(search_catalogue(request.args))
+
+    '''
+  @ implement endpoint
+    GET /stats
+    actors per gender, actors per age bucket and movies per release year,
+    aggregated in the database, see stats.catalogue_stats
+  '''
+    @app.route('/stats')
+    @requires_auth(any_of=['get:actors', 'get:movies'])
+    @read_only
+    @conditional('actors', 'movies', cache=True)
+    def get_stats(token):
+        return jsonify(catalogue_stats(request.args))
+
+    '''
+  @ implement endpoint
+    GET /cache/stats
+    hit / miss counters of this worker's response cache
+  '''
+    @app.route('/cache/stats')
+    @requires_auth(any_of=['get:actors', 'get:movies'])
+    def get_cache_stats(token):
+        cache = get_cache()
+        return jsonify({
+            'success': True,
+            'enabled': cache is not None,
+            'stats': cache.stats() if cache is not None else {}
+        })
+
+    '''
+  @ implement endpoint
+    GET /db/pool
+    occupancy and checkout wait counters of this worker's connection pools,
+    the primary's and each replica's
+  '''
+    @app.route('/db/pool')
+    @requires_auth(any_of=['get:actors', 'get:movies'])
+    def get_pool_status(token):
+        replicas = get_replicas()
+        return jsonify({
+            'success': True,
+            'pool': pool_status(db.engine.pool),
+            'replicas': [dict(pool_status(engine.pool),
+                              healthy=replicas.healthy(engine))
+                         for engine in replicas.engines] if replicas else []
+        })
+
+    '''
+  @ implement endpoint
+    GET /metrics
+    this worker's request latency, query count and SQL time histograms per
+    route plus response cache and connection pool gauges, in the
+    Prometheus text format
+  '''
+    @app.route('/metrics')
+    @requires_auth(app.config['METRICS_PERMISSION'])
+    def get_metrics(token):
+        gauges = []
+        cache = get_cache()
+        if cache is not None:
+            for name, value in cache.stats().items():
+                gauges.append((f'response_cache_{name}',
+                               f'Response cache {name}.', value))
+        for name, value in pool_status(db.engine.pool).items():
+            if isinstance(value, (int, float)):
+                gauges.append((f'db_pool_{name}',
+                               f'Connection pool {name}.', value))
+        return render_metrics(gauges)
+
+    '''
+  @ implement endpoint
+    GET /debug/profiles
+    the worst profiles this worker kept and its profiling settings
+  '''
+    @app.route('/debug/profiles')
+    @requires_auth(app.config['PROFILE_PERMISSION'])
+    def get_profiles(token):
+        return jsonify({
+            'success': True,
+            'config': profile_config(),
+            'profiles': current_app.extensions['profiles'].entries()
+        })
+
+    '''
+  @ implement endpoint
+    GET /debug/profiles/<id>
+    one profile, ?format=pstats or text for cprofile profiles, collapsed
+    or text for sampler ones
+  '''
+    @app.route('/debug/profiles/<int:id>')
+    @requires_auth(app.config['PROFILE_PERMISSION'])
+    def get_profile(token, id):
+        found = current_app.extensions['profiles'].get(id)
+        if found is None:
+            abort(404)
+
+        entry, data = found
+        fmt = request.args.get(
+            'format', 'pstats' if entry['mode'] == 'cprofile' else 'collapsed')
+        rendered = render(entry, data, fmt)
+        if rendered is None:
+            abort(400)
+
+        body, mimetype = rendered
+        response = current_app.response_class(body, mimetype=mimetype)
+        if fmt == 'pstats':
+            response.headers['Content-Disposition'] = \
+                f'attachment; filename=profile-{id}.pstats'
+        return response
+
+    '''
+  @ implement endpoint
+    PATCH /debug/profiles/config
+    turns profiling on or off for this worker, sets its sample rate and
+    mode
+  '''
+    @app.route('/debug/profiles/config', methods=['PATCH'])
+    @requires_auth(app.config['PROFILE_ADMIN_PERMISSION'])
+    def update_profile_config(token):
+        body = request.get_json(silent=True)
+        if not isinstance(body, dict) or not body or \
+                set(body) - {'enabled', 'sample_rate', 'mode'}:
+            return unprocessable_entity(
+                'expected enabled, sample_rate and / or mode')
+
+        enabled = body.get('enabled', current_app.config['PROFILE_ENABLED'])
+        rate = body.get('sample_rate',
+                        current_app.config['PROFILE_SAMPLE_RATE'])
+        mode = body.get('mode', current_app.config['PROFILE_MODE'])
+        if not isinstance(enabled, bool):
+            return unprocessable_entity('enabled must be a boolean')
+        if isinstance(rate, bool) or not isinstance(rate, (int, float)) \
+                or not 0 <= rate <= 1:
+            return unprocessable_entity('sample_rate must be between 0 and 1')
+        if mode not in PROFILE_MODES:
+            return unprocessable_entity('mode must be cprofile or sampler')
+
+        current_app.config.update(PROFILE_ENABLED=enabled,
+                                  PROFILE_SAMPLE_RATE=rate,
+                                  PROFILE_MODE=mode)
+        return jsonify({
+            'success': True,
+            'config': profile_config()
+        })
+
     # =====================================POST Requests======================
 
     '''
   @ implement endpoint
     POST /actors
+    a json array creates a batch of actors, see create_batch
   '''
     @app.route('/actors', methods=['POST'])
     @requires_auth('post:actors')
     def create_actors(token):
 
-        try:
-
-            body = request.get_json()
-
-            new_name = body.get('name', None)
-            new_age = body.get('age', None)
-            new_gender = body.get('gender', None)
+        body = request.get_json(silent=True)
+        if isinstance(body, list):
+            return create_batch(Actor, 'actors', body)
 
-            if new_name is None:
-                abort(404)
+        try:
 
-            actor = Actor(name=new_name, age=new_age, gender=new_gender)
+            actor = Actor(**Actor.validate(body))
             actor.insert()
 
             return jsonify({
@@ -95,22 +534,19 @@ def create_app(test_config=None):
     '''
   @ implement endpoint
     POST /movies
+    a json array creates a batch of movies, see create_batch
   '''
     @app.route('/movies', methods=['POST'])
     @requires_auth('post:movies')
     def create_movies(token):
 
-        try:
-
-            body = request.get_json()
-
-            new_title = body.get('title', None)
-            new_release_date = body.get('release_date', None)
+        body = request.get_json(silent=True)
+        if isinstance(body, list):
+            return create_batch(Movie, 'movies', body)
 
-            if new_title is None:
-                abort(404)
+        try:
 
-            movie = Movie(title=new_title, release_date=new_release_date)
+            movie = Movie(**Movie.validate(body))
             movie.insert()
 
             return jsonify({
@@ -191,6 +627,58 @@ def create_app(test_config=None):
         except Exception:
             abort(422)
 
+    '''
+  @ implement endpoint
+    PATCH /actors
+    bulk update, see update_bulk
+  '''
+    @app.route('/actors', methods=['PATCH'])
+    @requires_auth('patch:actors')
+    def update_actors_bulk(token):
+        return update_bulk(Actor, request.get_json(silent=True))
+
+    '''
+  @ implement endpoint
+    PATCH /movies
+    bulk update, see update_bulk
+  '''
+    @app.route('/movies', methods=['PATCH'])
+    @requires_auth('patch:movies')
+    def update_movies_bulk(token):
+        return update_bulk(Movie, request.get_json(silent=True))
+
+    '''
+  @ implement endpoint
+    POST /movies/<id>/actors
+    casts the actors in {"actor_ids": [...]} in the movie, in one
+    transaction
+  '''
+    @app.route('/movies/<int:id>/actors', methods=['POST'])
+    @requires_auth('patch:movies')
+    def add_movie_cast(token, id):
+        movie = Movie.query.filter(Movie.id == id).one_or_none()
+        if movie is None:
+            abort(404)
+
+        body = request.get_json(silent=True) or {}
+        actor_ids = body.get('actor_ids')
+        if (not isinstance(actor_ids, list) or not actor_ids
+                or not all(type(actor_id) is int for actor_id in actor_ids)
+                or len(actor_ids) > current_app.config['MAX_BATCH_SIZE']):
+            return unprocessable_entity('actor_ids must be a list of integers')
+
+        try:
+            added = movie.add_cast(actor_ids)
+        except ValueError as e:
+            db.session.rollback()
+            return unprocessable_entity(str(e))
+
+        return jsonify({
+            'success': True,
+            'movie': id,
+            'added': added
+        })
+
     # =====================================DELETE Requests====================
 
     '''
@@ -239,8 +727,54 @@ def create_app(test_config=None):
         except Exception:
             abort(422)
 
+    '''
+  @ implement endpoint
+    DELETE /actors
+    bulk delete, see delete_bulk
+  '''
+    @app.route('/actors', methods=['DELETE'])
+    @requires_auth('delete:actors')
+    def delete_actors_bulk(token):
+        return delete_bulk(Actor, request.get_json(silent=True))
+
+    '''
+  @ implement endpoint
+    DELETE /movies
+    bulk delete, see delete_bulk
+  '''
+    @app.route('/movies', methods=['DELETE'])
+    @requires_auth('delete:movies')
+    def delete_movies_bulk(token):
+        return delete_bulk(Movie, request.get_json(silent=True))
+
+    '''
+  @ implement endpoint
+    DELETE /movies/<id>/actors/<actor_id>
+    removes an actor from the movie's cast
+  '''
+    @app.route('/movies/<int:id>/actors/<int:actor_id>', methods=['DELETE'])
+    @requires_auth('patch:movies')
+    def remove_movie_cast(token, id, actor_id):
+        movie = Movie.query.filter(Movie.id == id).one_or_none()
+        if movie is None or not movie.remove_cast(actor_id):
+            abort(404)
+
+        return jsonify({
+            'success': True,
+            'movie': id,
+            'delete': actor_id
+        })
+
     # =====================================Error Handlers=====================
 
+    @app.errorhandler(400)
+    def bad_request(error):
+        return jsonify({
+            "success": False,
+            "error": 400,
+            "message": "bad request"
+        }), 400
+
     @app.errorhandler(422)
     def unprocessable(error):
         return jsonify({
@@ -1,14 +1,33 @@
+import hashlib
 import json
+import logging
 import os
+import threading
+import time
 from flask import request, _request_ctx_stack
+from collections import OrderedDict
 from functools import wraps
 from jose import jwt
 from urllib.request import urlopen
 
+from instrumentation import phase
+
 
 AUTH0_DOMAIN = os.environ['AUTH0_DOMAIN']
 ALGORITHMS = ['RS256']
 API_AUDIENCE = os.environ['API_AUDIENCE']
+# the benchmarks point this at their local stand-in identity provider
+AUTH0_JWKS_URL = os.environ.get(
+    'AUTH0_JWKS_URL', f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
+
+JWKS_CACHE_TTL = float(os.environ.get('JWKS_CACHE_TTL', 3600))
+JWKS_FETCH_TIMEOUT = float(os.environ.get('JWKS_FETCH_TIMEOUT', 5))
+JWKS_MISS_REFETCH_INTERVAL = float(
+    os.environ.get('JWKS_MISS_REFETCH_INTERVAL', 30))
+JWKS_RETRY_INTERVAL = float(os.environ.get('JWKS_RETRY_INTERVAL', 30))
+TOKEN_CACHE_SIZE = int(os.environ.get('TOKEN_CACHE_SIZE', 1024))
+
+logger = logging.getLogger(__name__)
 
 
 # AuthError Exception
@@ -24,6 +43,184 @@ class AuthError(Exception):
         self.status_code = status_code
 
 
+# JWKS Cache
+'''
+JWKSCache
+    per-process store of the Auth0 signing keys, indexed by kid
+    keys are refreshed in a background thread once they reach
+    REFRESH_AHEAD of the ttl, and fetched synchronously only when the
+    cache is cold or fully expired
+    an unknown kid triggers one refetch (at most every miss_interval
+    seconds) so key rotation is picked up without waiting for the ttl
+    if a refresh fails while keys are cached, the stale keys keep serving
+    and no fetch is tried again for retry_interval seconds, so an identity
+    provider outage does not put a blocking fetch in front of every request
+'''
+
+
+class JWKSCache:
+    REFRESH_AHEAD = 0.8
+
+    def __init__(self, url, ttl=JWKS_CACHE_TTL, timeout=JWKS_FETCH_TIMEOUT,
+                 miss_interval=JWKS_MISS_REFETCH_INTERVAL,
+                 retry_interval=JWKS_RETRY_INTERVAL):
+        self.url = url
+        self.ttl = ttl
+        self.timeout = timeout
+        self.miss_interval = miss_interval
+        self.retry_interval = retry_interval
+        self._keys = {}
+        self._fetched_at = float('-inf')
+        self._last_miss_refetch = float('-inf')
+        self._retry_at = float('-inf')
+        self._fetch_lock = threading.Lock()
+        self._refreshing = False
+
+    def _fetch(self):
+        with urlopen(self.url, timeout=self.timeout) as jsonurl:
+            jwks = json.loads(jsonurl.read())
+
+        keys = {}
+        for key in jwks['keys']:
+            if 'kid' not in key:
+                continue
+            keys[key['kid']] = {
+                'kty': key['kty'],
+                'kid': key['kid'],
+                'use': key.get('use'),
+                'n': key['n'],
+                'e': key['e']
+            }
+        return keys
+
+    def refresh(self, observed_at=None):
+        with self._fetch_lock:
+            # another thread refreshed while we were waiting for the lock
+            if observed_at is not None and self._fetched_at > observed_at:
+                return
+            # or failed, the stale keys serve until the retry time
+            if self._keys and time.monotonic() < self._retry_at:
+                return
+            try:
+                keys = self._fetch()
+            except Exception:
+                if not self._keys:
+                    raise
+                logger.warning('JWKS refresh failed, serving cached keys',
+                               exc_info=True)
+                self._retry_at = time.monotonic() + self.retry_interval
+                return
+            self._keys = keys
+            self._fetched_at = time.monotonic()
+            self._retry_at = float('-inf')
+
+    def _refresh_in_background(self, observed_at):
+        if self._refreshing:
+            return
+        self._refreshing = True
+
+        def run():
+            try:
+                self.refresh(observed_at=observed_at)
+            finally:
+                self._refreshing = False
+
+        threading.Thread(target=run, daemon=True).start()
+
+    def get_key(self, kid):
+        fetched_at = self._fetched_at
+        now = time.monotonic()
+        age = now - fetched_at
+        backing_off = self._keys and now < self._retry_at
+        refreshed = False
+        if not backing_off:
+            if age >= self.ttl:
+                self.refresh(observed_at=fetched_at)
+                refreshed = True
+            elif age >= self.ttl * self.REFRESH_AHEAD:
+                self._refresh_in_background(fetched_at)
+
+        key = self._keys.get(kid)
+        if key is None and not refreshed and not backing_off:
+            now = time.monotonic()
+            if now - self._last_miss_refetch >= self.miss_interval:
+                self._last_miss_refetch = now
+                self.refresh(observed_at=self._fetched_at)
+                key = self._keys.get(kid)
+        return key
+
+    def clear(self):
+        with self._fetch_lock:
+            self._keys = {}
+            self._fetched_at = float('-inf')
+            self._last_miss_refetch = float('-inf')
+            self._retry_at = float('-inf')
+
+
+jwks_cache = JWKSCache(AUTH0_JWKS_URL)
+
+
+# Verified Token Cache
+'''
+TokenCache
+    bounded LRU of already verified tokens, keyed by the sha256 of the
+    raw token so the cache never holds bearer credentials
+    each entry holds the (payload, granted permissions) pair built by
+    decode_verified_token, so permission checks on a cache hit allocate
+    nothing
+    entries are dropped once the token's exp claim has passed, tokens
+    without an exp claim are never cached
+    maxsize is an entry count, 0 disables the cache
+'''
+
+
+class TokenCache:
+    def __init__(self, maxsize=TOKEN_CACHE_SIZE):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(token):
+        return hashlib.sha256(token.encode('utf-8')).digest()
+
+    def get(self, token):
+        if not self.maxsize:
+            return None
+        key = self._key(token)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            exp, claims = entry
+            if exp <= time.time():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return claims
+
+    def put(self, token, claims):
+        exp = claims[0].get('exp')
+        if not self.maxsize or not isinstance(exp, (int, float)):
+            return
+        key = self._key(token)
+        with self._lock:
+            self._entries[key] = (exp, claims)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+token_cache = TokenCache()
+
+
 # Auth Header
 '''
 @ implement get_token_auth_header() method
@@ -68,11 +265,73 @@ def get_token_auth_header():
     return token
 
 
+# Permissions
+'''
+Permissions
+    a permission requirement compiled once, when requires_auth decorates
+    a view
+    mode 'all' needs every permission in required, mode 'any' needs at
+    least one of them
+
+compile_permissions(permission, any_of, all_of)
+    builds the Permissions for the requires_auth arguments, a single
+    permission string is the same as all_of=[permission]
+'''
+
+
+class Permissions:
+    def __init__(self, required, mode='all'):
+        if mode not in ('all', 'any'):
+            raise ValueError(f'unknown permission mode {mode!r}')
+        self.required = frozenset(required)
+        self.mode = mode
+
+    def satisfied_by(self, granted):
+        if self.mode == 'any':
+            return not self.required.isdisjoint(granted)
+        return self.required <= granted
+
+    def __repr__(self):
+        return f'Permissions({sorted(self.required)!r}, mode={self.mode!r})'
+
+
+def compile_permissions(permission='', any_of=None, all_of=None):
+    if isinstance(permission, Permissions):
+        return permission
+    if any_of is not None and all_of is not None:
+        raise ValueError('pass either any_of or all_of, not both')
+    if any_of is not None:
+        return Permissions(any_of, mode='any')
+    if all_of is not None:
+        return Permissions(all_of, mode='all')
+    return Permissions([permission])
+
+
+def granted_permissions(payload):
+    permissions = payload.get('permissions')
+    if permissions is None:
+        return None
+    return frozenset(permissions)
+
+
+PERMISSIONS_MISSING = {
+    'code': 'invalid_claims',
+    'description': 'Permissions not included in JWT.'
+}
+PERMISSION_NOT_FOUND = {
+    'code': 'unauthorized',
+    'description': 'Permission not found.'
+}
+
+
 '''
 @ implement check_permissions(permission, payload) method
     @INPUTS
-        permission: string permission (i.e. 'post:drink')
+        permission: string permission (i.e. 'post:drink') or a compiled
+            Permissions requirement
         payload: decoded jwt payload
+        granted: optional frozenset of the payload permissions, built from
+            the payload when omitted
     it should raise an AuthError if permissions are not included in the payload
         !!NOTE check your RBAC settings in Auth0
     it should raise an AuthError if the requested permission string is not in the payload permissions array
@@ -80,19 +339,15 @@ def get_token_auth_header():
 '''
 
 
-def check_permissions(permission, payload):
+def check_permissions(permission, payload, granted=None):
+    if granted is None:
+        granted = granted_permissions(payload)
 
-    if 'permissions' not in payload:
-        raise AuthError({
-            'code': 'invalid_claims',
-            'description': 'Permissions not included in JWT.'
-        }, 401)
+    if granted is None:
+        raise AuthError(PERMISSIONS_MISSING, 401)
 
-    if permission not in payload['permissions']:
-        raise AuthError({
-            'code': 'unauthorized',
-            'description': 'Permission not found.'
-        }, 403)
+    if not compile_permissions(permission).satisfied_by(granted):
+        raise AuthError(PERMISSION_NOT_FOUND, 403)
 
     return True
 
@@ -103,6 +358,9 @@ def check_permissions(permission, payload):
         token: a json web token (string)
     it should be an Auth0 token with key id (kid)
     it should verify the token using Auth0 /.well-known/jwks.json
+        (served from the per-process jwks_cache)
+    tokens that already passed verification are served from token_cache
+        until their exp claim
     it should decode the payload from the token
     it should validate the claims
     return the decoded payload
@@ -111,36 +369,44 @@ def check_permissions(permission, payload):
 
 
 def verify_decode_jwt(token):
-    jsonurl = urlopen(f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
-    jwks = json.loads(jsonurl.read())
+    return decode_verified_token(token)[0]
+
+
+'''
+decode_verified_token(token)
+    verify_decode_jwt plus the frozenset of granted permissions
+    return a (payload, granted) pair, cached in token_cache until exp
+'''
+
+
+def decode_verified_token(token):
+    claims = token_cache.get(token)
+    if claims is not None:
+        return claims
+
     unverified_header = jwt.get_unverified_header(token)
-    rsa_key = {}
     if 'kid' not in unverified_header:
         raise AuthError({
             'code': 'invalid_header',
             'description': 'Authorization malformed.'
         }, 401)
 
-    for key in jwks['keys']:
-        if key['kid'] == unverified_header['kid']:
-            rsa_key = {
-                'kty': key['kty'],
-                'kid': key['kid'],
-                'use': key['use'],
-                'n': key['n'],
-                'e': key['e']
-            }
+    with phase('jwks'):
+        rsa_key = jwks_cache.get_key(unverified_header['kid'])
     if rsa_key:
         try:
-            payload = jwt.decode(
-                token,
-                rsa_key,
-                algorithms=ALGORITHMS,
-                audience=API_AUDIENCE,
-                issuer='https://' + AUTH0_DOMAIN + '/'
-            )
-
-            return payload
+            with phase('jwt'):
+                payload = jwt.decode(
+                    token,
+                    rsa_key,
+                    algorithms=ALGORITHMS,
+                    audience=API_AUDIENCE,
+                    issuer='https://' + AUTH0_DOMAIN + '/'
+                )
+
+            claims = (payload, granted_permissions(payload))
+            token_cache.put(token, claims)
+            return claims
 
         except jwt.ExpiredSignatureError:
             raise AuthError({
@@ -168,20 +434,31 @@ def verify_decode_jwt(token):
 @ implement @requires_auth(permission) decorator method
     @INPUTS
         permission: string permission (i.e. 'post:drink')
+        any_of: permissions of which the token needs at least one
+        all_of: permissions the token needs every one of
+    the requirement is compiled once, when the view is decorated
     it should use the get_token_auth_header method to get the token
-    it should use the verify_decode_jwt method to decode the jwt
+    it should use the decode_verified_token method to decode the jwt
     it should use the check_permissions method validate claims and check the requested permission
+    the payload and granted permissions are kept on the request context as
+        current_user and current_permissions
     return the decorator which passes the decoded payload to the decorated method
 '''
 
 
-def requires_auth(permission=''):
+def requires_auth(permission='', any_of=None, all_of=None):
+    required = compile_permissions(permission, any_of=any_of, all_of=all_of)
+
     def requires_auth_decorator(f):
         @wraps(f)
         def wrapper(*args, **kwargs):
-            token = get_token_auth_header()
-            payload = verify_decode_jwt(token)
-            check_permissions(permission, payload)
+            with phase('auth_header'):
+                token = get_token_auth_header()
+            payload, granted = decode_verified_token(token)
+            check_permissions(required, payload, granted)
+            ctx = _request_ctx_stack.top
+            ctx.current_user = payload
+            ctx.current_permissions = granted
             return f(payload, *args, **kwargs)
 
         return wrapper
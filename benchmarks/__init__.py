@@ -0,0 +1,21 @@
+import os
+
+
+'''
+benchmarks
+    offline load tests of the API: a stand-in identity provider (idp),
+    generated catalogues (seed), the request mixes (scenarios) and the
+    runner driving gunicorn with them (run)
+    python -m benchmarks.run --help
+
+auth.py reads these at import, the local identity provider signs its
+tokens for whatever they are set to
+importing app builds its module level app, which never connects to
+DATABASE_URL here: the benchmarks pass their database to create_app and
+to gunicorn explicitly
+'''
+
+
+os.environ.setdefault('AUTH0_DOMAIN', 'agency-bench.local')
+os.environ.setdefault('API_AUDIENCE', 'agency')
+os.environ.setdefault('DATABASE_URL', 'sqlite://')
@@ -0,0 +1,145 @@
+import argparse
+import base64
+import json
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import rsa
+from jose import jwt
+
+
+'''
+Roles
+    the permissions of the three Auth0 roles (see the README)
+'''
+
+
+ROLES = {
+    'casting_assistant': ['get:actors', 'get:movies'],
+    'casting_director': ['get:actors', 'get:movies', 'post:actors',
+                         'delete:actors', 'patch:actors', 'patch:movies'],
+    'executive_producer': ['get:actors', 'get:movies', 'post:actors',
+                           'post:movies', 'delete:actors', 'delete:movies',
+                           'patch:actors', 'patch:movies']
+}
+
+TOKEN_LIFETIME = 24 * 3600
+
+
+def _b64(number):
+    data = number.to_bytes((number.bit_length() + 7) // 8, 'big')
+    return base64.urlsafe_b64encode(data).decode().rstrip('=')
+
+
+'''
+IdentityProvider
+    stand-in for the Auth0 tenant: a throwaway RSA key, its JWKS and role
+    tokens signed with it for AUTH0_DOMAIN / API_AUDIENCE
+    serve() publishes the JWKS (and GET /token?role=&sub= for other load
+    tools) over http on localhost, the app finds it through AUTH0_JWKS_URL
+'''
+
+
+class IdentityProvider:
+    def __init__(self, kid='bench', bits=2048):
+        self.kid = kid
+        public, private = rsa.newkeys(bits)
+        self._pem = private.save_pkcs1().decode()
+        self.jwks = {'keys': [{
+            'kty': 'RSA',
+            'kid': kid,
+            'use': 'sig',
+            'alg': 'RS256',
+            'n': _b64(public.n),
+            'e': _b64(public.e)
+        }]}
+        self._server = None
+
+    def mint(self, role, sub='bench-user'):
+        if role not in ROLES:
+            raise ValueError(f'unknown role {role}')
+        now = int(time.time())
+        claims = {
+            'iss': 'https://{}/'.format(os.environ['AUTH0_DOMAIN']),
+            'aud': os.environ['API_AUDIENCE'],
+            'sub': sub,
+            'iat': now,
+            'exp': now + TOKEN_LIFETIME,
+            'permissions': ROLES[role]
+        }
+        return jwt.encode(claims, self._pem, algorithm='RS256',
+                          headers={'kid': self.kid})
+
+    def serve(self, port=0):
+        provider = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                url = urlparse(self.path)
+                if url.path == '/.well-known/jwks.json':
+                    self._send(200, provider.jwks)
+                elif url.path == '/token':
+                    query = parse_qs(url.query)
+                    try:
+                        token = provider.mint(
+                            query.get('role', ['casting_assistant'])[0],
+                            query.get('sub', ['bench-user'])[0])
+                    except ValueError as e:
+                        self._send(400, {'message': str(e)})
+                        return
+                    self._send(200, {'access_token': token})
+                else:
+                    self._send(404, {'message': 'not found'})
+
+            def _send(self, status, body):
+                data = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+        threading.Thread(target=self._server.serve_forever,
+                         daemon=True).start()
+        return self.jwks_url
+
+    @property
+    def jwks_url(self):
+        host, port = self._server.server_address
+        return f'http://{host}:{port}/.well-known/jwks.json'
+
+    def shutdown(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Serve a local JWKS and print a token per role')
+    parser.add_argument('--port', type=int, default=8400)
+    args = parser.parse_args()
+
+    provider = IdentityProvider()
+    print(f'export AUTH0_JWKS_URL={provider.serve(args.port)}')
+    print('export AUTH0_DOMAIN={} API_AUDIENCE={}'.format(
+        os.environ['AUTH0_DOMAIN'], os.environ['API_AUDIENCE']))
+    for role in ROLES:
+        print(f'export {role.upper()}_TOKEN={provider.mint(role)}')
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        provider.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,151 @@
+import os
+import random
+import sys
+
+import pytest
+
+import benchmarks  # noqa: F401 (auth settings for the app import)
+import auth
+from app import create_app
+from auth import (JWKSCache, check_permissions, compile_permissions,
+                  decode_verified_token, get_token_auth_header, token_cache,
+                  verify_decode_jwt)
+from benchmarks.idp import IdentityProvider
+from benchmarks.seed import actor_row, movie_row
+from flask import jsonify
+from models import Actor, Movie
+
+
+'''
+Microbenchmarks
+    the per request costs every endpoint pays: reading the bearer token,
+    verifying it (against the local identity provider, cold and from the
+    token cache), checking permissions, formatting rows and encoding the
+    json response
+    run with pytest-benchmark through main(), see the README:
+        python -m benchmarks.micro            run and print
+        python -m benchmarks.micro save       store a baseline
+        python -m benchmarks.micro compare    fail on regressions against
+                                              the latest baseline
+'''
+
+
+ROW_COUNT = 10000
+STORAGE = 'file://' + os.path.join(os.path.dirname(__file__), 'results')
+COMPARE_FAIL = os.environ.get('MICRO_COMPARE_FAIL', 'median:10%')
+
+
+@pytest.fixture(scope='module')
+def app():
+    return create_app({'SQLALCHEMY_DATABASE_URI': 'sqlite://',
+                       'DB_STARTUP_MODE': 'none'})
+
+
+@pytest.fixture(scope='module')
+def token():
+    provider = IdentityProvider()
+    jwks_cache = auth.jwks_cache
+    auth.jwks_cache = JWKSCache(provider.serve())
+    yield provider.mint('executive_producer')
+    auth.jwks_cache = jwks_cache
+    provider.shutdown()
+    token_cache.clear()
+
+
+@pytest.fixture(scope='module')
+def rows():
+    rng = random.Random(0)
+    actors = []
+    movies = []
+    for id in range(1, ROW_COUNT + 1):
+        actor = Actor(**actor_row(rng))
+        actor.id = id
+        actors.append(actor)
+        movie = Movie(**movie_row(rng))
+        movie.id = id
+        movies.append(movie)
+    return actors, movies
+
+
+@pytest.mark.benchmark(group='auth')
+def test_get_token_auth_header(benchmark, app, token):
+    with app.test_request_context(
+            headers={'Authorization': f'Bearer {token}'}):
+        assert benchmark(get_token_auth_header) == token
+
+
+@pytest.mark.benchmark(group='auth')
+def test_verify_decode_jwt(benchmark, token):
+    payload = benchmark.pedantic(verify_decode_jwt, args=(token,),
+                                 setup=token_cache.clear, rounds=200)
+    assert payload['sub'] == 'bench-user'
+
+
+@pytest.mark.benchmark(group='auth')
+def test_verify_decode_jwt_cached(benchmark, token):
+    verify_decode_jwt(token)
+    assert benchmark(verify_decode_jwt, token)['sub'] == 'bench-user'
+
+
+@pytest.mark.benchmark(group='auth')
+def test_check_permissions(benchmark, token):
+    payload, granted = decode_verified_token(token)
+    assert benchmark(check_permissions, 'patch:movies', payload, granted)
+
+
+@pytest.mark.benchmark(group='auth')
+def test_check_permissions_any_of(benchmark, token):
+    required = compile_permissions(any_of=['get:actors', 'get:movies'])
+    payload, granted = decode_verified_token(token)
+    assert benchmark(check_permissions, required, payload, granted)
+
+
+@pytest.mark.benchmark(group='format')
+def test_actor_format(benchmark, rows):
+    actors, _ = rows
+    result = benchmark(lambda: [actor.format() for actor in actors])
+    assert len(result) == ROW_COUNT
+
+
+@pytest.mark.benchmark(group='format')
+def test_movie_format(benchmark, rows):
+    _, movies = rows
+    result = benchmark(lambda: [movie.format() for movie in movies])
+    assert len(result) == ROW_COUNT
+
+
+@pytest.mark.benchmark(group='jsonify')
+def test_jsonify_actors(benchmark, app, rows):
+    actors = [actor.format() for actor in rows[0]]
+    with app.test_request_context():
+        response = benchmark(jsonify, {'success': True, 'actors': actors})
+    assert response.status_code == 200
+
+
+@pytest.mark.benchmark(group='jsonify')
+def test_jsonify_movies(benchmark, app, rows):
+    movies = [movie.format() for movie in rows[1]]
+    with app.test_request_context():
+        response = benchmark(jsonify, {'success': True, 'movies': movies})
+    assert response.status_code == 200
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    command = argv[0] if argv and not argv[0].startswith('-') else 'run'
+    extra = argv[1:] if command != 'run' or argv[:1] == ['run'] else argv
+
+    args = [__file__, '-q', '-p', 'no:cacheprovider',
+            f'--benchmark-storage={STORAGE}']
+    if command == 'save':
+        args.append('--benchmark-save=baseline')
+    elif command == 'compare':
+        args.extend(['--benchmark-compare',
+                     f'--benchmark-compare-fail={COMPARE_FAIL}'])
+    elif command != 'run':
+        sys.exit(f'unknown command {command}, use run, save or compare')
+    return pytest.main(args + extra)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,327 @@
+import argparse
+import http.client
+import json
+import math
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import benchmarks  # noqa: F401 (auth settings for the app import)
+from benchmarks.idp import IdentityProvider
+from benchmarks.scenarios import SCENARIOS
+from benchmarks.seed import id_range, seed
+from app import create_app
+from models import Actor, Movie
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+GATED = ('p50_ms', 'p95_ms', 'p99_ms')
+
+
+'''
+Results
+    summarize() turns the latencies of one scenario into its report,
+    percentiles are nearest rank
+'''
+
+
+def percentile(ordered, p):
+    if not ordered:
+        return None
+    rank = max(math.ceil(p / 100 * len(ordered)), 1)
+    return ordered[rank - 1]
+
+
+def summarize(latencies, errors, elapsed):
+    ordered = sorted(latencies)
+
+    def ms(seconds):
+        return None if seconds is None else round(seconds * 1000, 3)
+
+    return {
+        'requests': len(ordered),
+        'errors': errors,
+        'rps': round(len(ordered) / elapsed, 2) if elapsed else 0.0,
+        'mean_ms': ms(sum(ordered) / len(ordered)) if ordered else None,
+        'p50_ms': ms(percentile(ordered, 50)),
+        'p95_ms': ms(percentile(ordered, 95)),
+        'p99_ms': ms(percentile(ordered, 99)),
+        'max_ms': ms(ordered[-1]) if ordered else None
+    }
+
+
+'''
+compare(results, baseline, tolerance)
+    the regressions of results against a previous run's output: a scenario
+    with errors, a gated percentile more than tolerance (a fraction) above
+    the baseline's, or requests per second more than tolerance below it
+    scenarios missing from either side are not compared
+'''
+
+
+def compare(results, baseline, tolerance):
+    regressions = []
+    for name, current in results['scenarios'].items():
+        if current['errors']:
+            regressions.append(f"{name}: {current['errors']} errors")
+        before = baseline.get('scenarios', {}).get(name)
+        if before is None:
+            continue
+        for key in GATED:
+            if current[key] is None or before.get(key) is None:
+                continue
+            if current[key] > before[key] * (1 + tolerance):
+                regressions.append('{}: {} {} ms, baseline {} ms'.format(
+                    name, key, current[key], before[key]))
+        if before.get('rps') and \
+                current['rps'] < before['rps'] * (1 - tolerance):
+            regressions.append('{}: {} rps, baseline {} rps'.format(
+                name, current['rps'], before['rps']))
+    return regressions
+
+
+'''
+Load
+    every virtual user is a thread with its own keep-alive connection, its
+    own token (sub bench-<n>) and its own seeded random.Random
+    requests answered with anything but a 2xx count as errors, their
+    latency is not recorded
+'''
+
+
+class VirtualUser(threading.Thread):
+    def __init__(self, port, token, scenario, catalogue, rng, deadline):
+        super().__init__(daemon=True)
+        self.port = port
+        self.headers = {'Authorization': f'Bearer {token}',
+                        'Content-Type': 'application/json'}
+        self.requests = scenario(catalogue, rng)
+        self.deadline = deadline
+        self.latencies = []
+        self.errors = 0
+
+    def _send(self, connection, method, path, body):
+        payload = None if body is None else json.dumps(body, default=str)
+        started = time.perf_counter()
+        connection.request(method, path, body=payload, headers=self.headers)
+        response = connection.getresponse()
+        data = response.read()
+        elapsed = time.perf_counter() - started
+        if not 200 <= response.status < 300:
+            self.errors += 1
+            return None
+        self.latencies.append(elapsed)
+        return json.loads(data) if data else None
+
+    def run(self):
+        connection = http.client.HTTPConnection('127.0.0.1', self.port,
+                                                timeout=60)
+        response = None
+        try:
+            while time.perf_counter() < self.deadline:
+                try:
+                    method, path, body = self.requests.send(response)
+                except StopIteration:
+                    return
+                try:
+                    response = self._send(connection, method, path, body)
+                except (OSError, http.client.HTTPException):
+                    self.errors += 1
+                    response = None
+                    connection.close()
+        finally:
+            connection.close()
+
+
+def run_scenario(port, provider, name, catalogue, concurrency, duration,
+                 seed_number):
+    role, scenario = SCENARIOS[name]
+    started = time.perf_counter()
+    users = [VirtualUser(port, provider.mint(role, f'bench-{n}'), scenario,
+                         catalogue, random.Random(f'{seed_number}-{name}-{n}'),
+                         started + duration)
+             for n in range(concurrency)]
+    for user in users:
+        user.start()
+    for user in users:
+        user.join()
+    elapsed = time.perf_counter() - started
+    return summarize([latency for user in users
+                      for latency in user.latencies],
+                     sum(user.errors for user in users), elapsed)
+
+
+'''
+Server
+    gunicorn with the repo's gunicorn.conf.py, pointed at the seeded
+    database and the local identity provider
+'''
+
+
+def start_server(args, jwks_url):
+    env = dict(os.environ,
+               PORT=str(args.port),
+               DATABASE_URL=args.database_url,
+               AUTH0_JWKS_URL=jwks_url,
+               DB_STARTUP_MODE='none',
+               WEB_CONCURRENCY=str(args.workers),
+               GUNICORN_WORKER_CLASS=args.worker_class,
+               # every virtual user sends the same reads, with the response
+               # cache on the list scenarios would only measure cache hits
+               RESPONSE_CACHE_ENTRIES='0',
+               REQUEST_LOG_LEVEL='WARNING')
+    return subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py',
+         'app:app'], cwd=ROOT, env=env)
+
+
+def wait_ready(port, token, server, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError('gunicorn exited with {}'.format(
+                server.returncode))
+        connection = http.client.HTTPConnection('127.0.0.1', port, timeout=5)
+        try:
+            connection.request('GET', '/actors?limit=1', headers={
+                'Authorization': f'Bearer {token}'})
+            if connection.getresponse().status == 200:
+                return
+        except (OSError, http.client.HTTPException):
+            pass
+        finally:
+            connection.close()
+        time.sleep(0.2)
+    raise RuntimeError(f'gunicorn did not answer within {timeout}s')
+
+
+def _revision():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT,
+            capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Load test the API under gunicorn, offline')
+    parser.add_argument('--database-url',
+                        help='defaults to a fresh SQLite file, use a '
+                        'Postgres url for numbers that mean something')
+    parser.add_argument('--actors', type=int, default=10000)
+    parser.add_argument('--movies', type=int, default=10000)
+    parser.add_argument('--skip-seed', action='store_true',
+                        help='keep the rows already in the database')
+    parser.add_argument('--create', action='store_true',
+                        help='create missing tables (create_all) first, '
+                        'implied for the default SQLite database')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS))
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--duration', type=float, default=10,
+                        help='seconds per scenario')
+    parser.add_argument('--warmup', type=float, default=2,
+                        help='unmeasured seconds before each scenario')
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--worker-class', default='sync',
+                        choices=('sync', 'gevent'))
+    parser.add_argument('--port', type=int, default=8100)
+    parser.add_argument('--output', default='-',
+                        help='json results file, - for stdout')
+    parser.add_argument('--baseline',
+                        help='a previous output to gate the results on')
+    parser.add_argument('--tolerance', type=float, default=0.15)
+    args = parser.parse_args(argv)
+
+    names = [name.strip() for name in args.scenarios.split(',')
+             if name.strip()]
+    unknown = set(names) - set(SCENARIOS)
+    if unknown:
+        parser.error('unknown scenarios: {}'.format(', '.join(sorted(unknown))))
+    args.scenarios = [name for name in SCENARIOS if name in names]
+
+    if args.database_url is None:
+        args.database_url = 'sqlite:///{}'.format(
+            os.path.join(tempfile.mkdtemp(prefix='agency-bench-'), 'bench.db'))
+        args.create = True
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    app = create_app({
+        'SQLALCHEMY_DATABASE_URI': args.database_url,
+        'DB_STARTUP_MODE': 'create' if args.create else 'none'
+    })
+    with app.app_context():
+        if not args.skip_seed:
+            seed(args.actors, args.movies, args.seed)
+        catalogue = {'actors': id_range(Actor), 'movies': id_range(Movie)}
+    if None in catalogue['actors']:
+        sys.exit('the database has no actors, drop --skip-seed')
+    lowest, highest = catalogue['actors']
+    catalogue['delete_ids'] = iter(range(highest, lowest - 1, -1))
+
+    provider = IdentityProvider()
+    server = start_server(args, provider.serve())
+    try:
+        wait_ready(args.port, provider.mint('casting_assistant'), server)
+        scenarios = {}
+        for name in args.scenarios:
+            if args.warmup:
+                run_scenario(args.port, provider, name, catalogue,
+                             args.concurrency, args.warmup, args.seed)
+            scenarios[name] = run_scenario(
+                args.port, provider, name, catalogue, args.concurrency,
+                args.duration, args.seed)
+            print('{}: {rps} rps, p50 {p50_ms} ms, p95 {p95_ms} ms, '
+                  'p99 {p99_ms} ms, {errors} errors'.format(
+                      name, **scenarios[name]), file=sys.stderr)
+    finally:
+        server.terminate()
+        server.wait(timeout=30)
+        provider.shutdown()
+
+    results = {
+        'meta': {
+            'revision': _revision(),
+            'recorded_at': time.time(),
+            'python': platform.python_version(),
+            'database': args.database_url.split(':', 1)[0],
+            'actors': catalogue['actors'],
+            'movies': catalogue['movies'],
+            'workers': args.workers,
+            'worker_class': args.worker_class,
+            'concurrency': args.concurrency,
+            'duration': args.duration,
+            'seed': args.seed
+        },
+        'scenarios': scenarios
+    }
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if args.output == '-':
+        print(output)
+    else:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f'REGRESSION {regression}', file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
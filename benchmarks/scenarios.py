@@ -0,0 +1,72 @@
+from benchmarks.seed import actor_row
+
+
+'''
+Scenarios
+    a scenario is a generator function run once per virtual user:
+        scenario(catalogue, rng) yields (method, path, json body or None)
+        and is sent back the decoded json of each response (None when the
+        request failed)
+    catalogue holds the seeded id ranges ('actors' / 'movies' as
+    (lowest, highest)) and the ids the delete scenario may still take
+    a scenario that returns ends its user early (e.g. nothing left to
+    delete)
+    SCENARIOS maps the names to (role of the token, scenario), in the
+    order they are run: the writes come last and delete last of all, so
+    the reads measure the seeded catalogue
+'''
+
+
+BULK_CREATE_SIZE = 100
+PAGE_SIZE = 100
+PAGES_PER_WALK = 20
+
+
+def list_catalogue(catalogue, rng):
+    while True:
+        yield 'GET', '/actors', None
+        yield 'GET', '/movies', None
+
+
+def paginate_actors(catalogue, rng):
+    while True:
+        path = f'/actors?limit={PAGE_SIZE}'
+        for _ in range(PAGES_PER_WALK):
+            page = yield 'GET', path, None
+            cursor = page and page.get('next_cursor')
+            if not cursor:
+                break
+            path = f'/actors?limit={PAGE_SIZE}&after={cursor}'
+
+
+def create_actor(catalogue, rng):
+    while True:
+        yield 'POST', '/actors', actor_row(rng)
+
+
+def bulk_create_actors(catalogue, rng):
+    while True:
+        yield 'POST', '/actors', [actor_row(rng)
+                                  for _ in range(BULK_CREATE_SIZE)]
+
+
+def patch_actor(catalogue, rng):
+    lowest, highest = catalogue['actors']
+    while True:
+        yield 'PATCH', '/actors/{}'.format(rng.randint(lowest, highest)), \
+            {'age': rng.randint(8, 90)}
+
+
+def delete_actor(catalogue, rng):
+    for id in catalogue['delete_ids']:
+        yield 'DELETE', f'/actors/{id}', None
+
+
+SCENARIOS = {
+    'list': ('casting_assistant', list_catalogue),
+    'paginate': ('casting_assistant', paginate_actors),
+    'create': ('casting_director', create_actor),
+    'bulk_create': ('casting_director', bulk_create_actors),
+    'patch': ('casting_director', patch_actor),
+    'delete': ('casting_director', delete_actor)
+}
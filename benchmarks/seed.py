@@ -0,0 +1,115 @@
+import argparse
+import random
+import time
+from datetime import date, timedelta
+
+import benchmarks  # noqa: F401 (auth settings for the app import)
+from app import create_app
+from models import Actor, Movie, castings, commit_write, db
+from sqlalchemy import func, select
+from stats import SUMMARY_COLUMNS, refresh_summary
+
+
+SEED_CHUNK = 10000
+
+FIRST_NAMES = ('Ada', 'Ben', 'Cleo', 'Dev', 'Eva', 'Finn', 'Gus', 'Hana',
+               'Ivo', 'Jade', 'Kai', 'Lena', 'Milo', 'Nia', 'Omar', 'Pia')
+LAST_NAMES = ('Adler', 'Brook', 'Chen', 'Diaz', 'Evans', 'Fox', 'Grant',
+              'Hill', 'Ito', 'Jones', 'Khan', 'Lopez', 'Moss', 'Novak')
+GENDERS = ('female', 'male', 'non-binary')
+TITLE_WORDS = ('Midnight', 'River', 'Glass', 'Empire', 'Summer', 'Ghost',
+               'Harbor', 'Signal', 'Paper', 'Crown', 'Winter', 'Echo')
+
+
+'''
+Generators
+    deterministic for a given random.Random, so a seed number always
+    yields the same catalogue
+'''
+
+
+def actor_row(rng):
+    return {
+        'name': '{} {}'.format(rng.choice(FIRST_NAMES),
+                               rng.choice(LAST_NAMES)),
+        'age': rng.randint(8, 90),
+        'gender': rng.choice(GENDERS)
+    }
+
+
+def movie_row(rng):
+    return {
+        'title': '{} {} {}'.format(rng.choice(TITLE_WORDS),
+                                   rng.choice(TITLE_WORDS),
+                                   rng.randint(1, 999)),
+        'release_date': date(1950, 1, 1) +
+        timedelta(days=rng.randint(0, 365 * 75))
+    }
+
+
+def _insert(model, make_row, count, rng):
+    table = model.__table__
+    for start in range(0, count, SEED_CHUNK):
+        rows = [make_row(rng)
+                for _ in range(min(SEED_CHUNK, count - start))]
+        db.session.execute(table.insert(), rows)
+        commit_write(table.name)
+
+
+'''
+seed(actors, movies, seed=0)
+    replaces the catalogue of the current app's database with generated
+    actors and movies, inserted SEED_CHUNK rows per statement
+    call it inside an app context
+'''
+
+
+def seed(actors, movies, seed=0):
+    rng = random.Random(seed)
+    db.session.execute(castings.delete())
+    db.session.execute(Actor.__table__.delete())
+    db.session.execute(Movie.__table__.delete())
+    commit_write('castings', 'actors', 'movies')
+
+    _insert(Actor, actor_row, actors, rng)
+    _insert(Movie, movie_row, movies, rng)
+    for table_name in SUMMARY_COLUMNS:
+        refresh_summary(table_name)
+
+
+'''
+id_range(model)
+    the lowest and highest id in the model's table, (None, None) when empty
+'''
+
+
+def id_range(model):
+    table = model.__table__
+    return tuple(db.session.execute(
+        select([func.min(table.c.id), func.max(table.c.id)])).first())
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Fill a database with generated actors and movies')
+    parser.add_argument('database_url')
+    parser.add_argument('--actors', type=int, default=1000)
+    parser.add_argument('--movies', type=int, default=1000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--create', action='store_true',
+                        help='create missing tables (create_all) first')
+    args = parser.parse_args()
+
+    app = create_app({
+        'SQLALCHEMY_DATABASE_URI': args.database_url,
+        'DB_STARTUP_MODE': 'create' if args.create else 'none'
+    })
+    started = time.perf_counter()
+    with app.app_context():
+        seed(args.actors, args.movies, args.seed)
+    print('seeded {} actors and {} movies in {:.1f}s'.format(
+        args.actors, args.movies, time.perf_counter() - started))
+
+
+if __name__ == '__main__':
+    main()
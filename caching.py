@@ -0,0 +1,323 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from functools import wraps
+from flask import Response, _request_ctx_stack, current_app, g
+from flask import has_app_context
+from flask import make_response, request
+from sqlalchemy import select
+
+from models import TableVersion, db, write_listeners
+
+
+RESPONSE_CACHE_ENTRIES = int(os.environ.get('RESPONSE_CACHE_ENTRIES', 512))
+RESPONSE_CACHE_BYTES = int(
+    os.environ.get('RESPONSE_CACHE_BYTES', 32 * 1024 * 1024))
+
+
+'''
+read_versions(table_names)
+    one small primary key lookup on table_versions
+    return a {table_name: (version, updated_at)} dict, tables that were
+    never written to are reported as (0, None)
+'''
+
+
+def read_versions(table_names):
+    versions = TableVersion.__table__
+    stmt = select([versions.c.table_name, versions.c.version,
+                   versions.c.updated_at]) \
+        .where(versions.c.table_name.in_(table_names))
+
+    found = {name: (0, None) for name in table_names}
+    for name, version, updated_at in db.session.execute(stmt):
+        found[name] = (version, updated_at)
+    return found
+
+
+'''
+make_etag(versions)
+    weak validator for the current request against the given table
+    versions, covering the path and the (order independent) query string
+'''
+
+
+def make_etag(versions):
+    args = sorted(request.args.items(multi=True))
+    raw = repr((sorted(versions.items()), request.path, args))
+    return hashlib.sha1(raw.encode('utf-8')).hexdigest()
+
+
+def _last_modified(versions):
+    stamps = [updated_at for _, updated_at in versions.values()
+              if updated_at is not None]
+    if not stamps:
+        return None
+    return max(stamps).replace(microsecond=0)
+
+
+def _not_modified(etag, last_modified):
+    if request.if_none_match:
+        return request.if_none_match.contains_weak(etag)
+    if last_modified is not None and request.if_modified_since is not None:
+        return last_modified <= request.if_modified_since
+    return False
+
+
+'''
+CachedResponse
+    what the response cache keeps for a response: the encoded body and
+    its mimetype (CORS and validator headers are added on every hit)
+    variants holds the body compressed per content coding ('gzip', 'br'),
+    filled in by compression.py the first time a client asks for one
+'''
+
+
+class CachedResponse:
+    __slots__ = ('body', 'mimetype', 'variants')
+
+    def __init__(self, body, mimetype, variants=None):
+        self.body = body
+        self.mimetype = mimetype
+        self.variants = variants or {}
+
+    @property
+    def size(self):
+        return len(self.body) + sum(len(body)
+                                    for body in self.variants.values())
+
+
+'''
+CacheBackend
+    storage interface for the response cache, a shared backend (redis,
+    memcached...) implements the same four methods
+    entries are tagged with the tables they were built from so a write to
+    a table drops exactly the entries that depend on it
+'''
+
+
+class CacheBackend:
+    def get(self, key):
+        raise NotImplementedError
+
+    def set(self, key, entry, tags):
+        raise NotImplementedError
+
+    def invalidate(self, tag):
+        raise NotImplementedError
+
+    def clear(self):
+        raise NotImplementedError
+
+
+'''
+LRUCacheBackend
+    in-process backend bounded by entry count and total body bytes,
+    least recently used entries are evicted first
+'''
+
+
+class LRUCacheBackend(CacheBackend):
+    def __init__(self, max_entries=RESPONSE_CACHE_ENTRIES,
+                 max_bytes=RESPONSE_CACHE_BYTES):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._entries = OrderedDict()
+        self._tags = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._entries.get(key)
+            if item is None:
+                return None
+            self._entries.move_to_end(key)
+            return item[0]
+
+    def set(self, key, entry, tags):
+        if entry.size > self.max_bytes:
+            return
+        with self._lock:
+            self._discard(key)
+            self._entries[key] = (entry, tags)
+            self.size += entry.size
+            for tag in tags:
+                self._tags.setdefault(tag, set()).add(key)
+            while (len(self._entries) > self.max_entries
+                   or self.size > self.max_bytes):
+                self._discard(next(iter(self._entries)))
+
+    def invalidate(self, tag):
+        with self._lock:
+            for key in self._tags.pop(tag, ()):
+                self._discard(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._tags.clear()
+            self.size = 0
+
+    def _discard(self, key):
+        item = self._entries.pop(key, None)
+        if item is None:
+            return
+        entry, tags = item
+        self.size -= entry.size
+        for tag in tags:
+            keys = self._tags.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._tags[tag]
+
+    def __len__(self):
+        return len(self._entries)
+
+
+'''
+ResponseCache
+    a backend plus hit / miss counters
+'''
+
+
+class ResponseCache:
+    def __init__(self, backend):
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        entry = self.backend.get(key)
+        if entry is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return entry
+
+    def set(self, key, entry, tags):
+        self.backend.set(key, entry, tags)
+
+    def invalidate(self, table_name):
+        self.backend.invalidate(table_name)
+
+    def stats(self):
+        stats = {'hits': self.hits, 'misses': self.misses}
+        if isinstance(self.backend, LRUCacheBackend):
+            stats['entries'] = len(self.backend)
+            stats['bytes'] = self.backend.size
+        return stats
+
+
+'''
+init_cache(app)
+    creates the app's response cache from RESPONSE_CACHE_ENTRIES and
+    RESPONSE_CACHE_BYTES, 0 entries disables it
+'''
+
+
+def init_cache(app):
+    app.config.setdefault('RESPONSE_CACHE_ENTRIES', RESPONSE_CACHE_ENTRIES)
+    app.config.setdefault('RESPONSE_CACHE_BYTES', RESPONSE_CACHE_BYTES)
+
+    cache = None
+    if app.config['RESPONSE_CACHE_ENTRIES']:
+        cache = ResponseCache(LRUCacheBackend(
+            max_entries=app.config['RESPONSE_CACHE_ENTRIES'],
+            max_bytes=app.config['RESPONSE_CACHE_BYTES']))
+    app.extensions['response_cache'] = cache
+    return cache
+
+
+def get_cache():
+    return current_app.extensions.get('response_cache')
+
+
+def _invalidate(table_name):
+    if has_app_context():
+        cache = get_cache()
+        if cache is not None:
+            cache.invalidate(table_name)
+
+
+write_listeners.append(_invalidate)
+
+
+'''
+cache keys cover the table versions, path and query string (all in the
+etag) and the caller's permission set
+'''
+
+
+def _cache_key(etag):
+    permissions = getattr(_request_ctx_stack.top, 'current_permissions', None)
+    raw = repr((etag, sorted(permissions or ())))
+    return hashlib.sha1(raw.encode('utf-8')).hexdigest()
+
+
+def _run_view(f, args, kwargs):
+    return make_response(f(*args, **kwargs))
+
+
+'''
+@conditional(*table_names, cache=False, embeds=None) decorator
+    conditional GET for read endpoints built from the given tables
+    embeds maps ?embed= values to the extra tables they read
+    it should read the table versions before running the view
+    it should answer If-None-Match / If-Modified-Since with a 304 without
+        running the view or touching any row data
+    with cache=True it should serve repeated requests from the app's
+        response cache (X-Cache: HIT / MISS) and store successful,
+        non-streamed responses in it; g.cache_entry keeps the (key, entry,
+        tags) of the request so compression can store its variants
+    it should add ETag and Last-Modified to successful responses
+    goes below @requires_auth so unauthenticated clients never get a 304
+        and the caller's permissions are known
+'''
+
+
+def conditional(*table_names, cache=False, embeds=None):
+    embeds = embeds or {}
+
+    def conditional_decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            tables = table_names + embeds.get(request.args.get('embed'), ())
+            versions = read_versions(tables)
+            etag = make_etag(versions)
+            last_modified = _last_modified(versions)
+
+            response_cache = get_cache() if cache else None
+            if _not_modified(etag, last_modified):
+                response = make_response('', 304)
+            elif response_cache is None:
+                response = _run_view(f, args, kwargs)
+            else:
+                key = _cache_key(etag)
+                entry = response_cache.get(key)
+                if entry is not None:
+                    response = Response(entry.body, mimetype=entry.mimetype)
+                    response.headers['X-Cache'] = 'HIT'
+                    g.cache_entry = (key, entry, tables)
+                else:
+                    response = _run_view(f, args, kwargs)
+                    if (response.status_code == 200
+                            and not response.is_streamed):
+                        entry = CachedResponse(response.get_data(),
+                                               response.mimetype)
+                        response_cache.set(key, entry, tables)
+                        g.cache_entry = (key, entry, tables)
+                    response.headers['X-Cache'] = 'MISS'
+
+            if response.status_code not in (200, 304):
+                return response
+
+            response.set_etag(etag, weak=True)
+            if last_modified is not None:
+                response.last_modified = last_modified
+            return response
+
+        return wrapper
+    return conditional_decorator
@@ -0,0 +1,140 @@
+import os
+import zlib
+from flask import current_app, g, request
+
+from caching import CachedResponse, get_cache
+from instrumentation import phase
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+COMPRESS_ENCODINGS = os.environ.get('COMPRESS_ENCODINGS', 'br,gzip')
+COMPRESS_MIN_SIZE = int(os.environ.get('COMPRESS_MIN_SIZE', 1024))
+COMPRESS_LEVEL = int(os.environ.get('COMPRESS_LEVEL', 6))
+COMPRESS_BROTLI_QUALITY = int(os.environ.get('COMPRESS_BROTLI_QUALITY', 4))
+
+COMPRESS_MIMETYPES = ('application/json', 'application/x-ndjson',
+                      'text/plain')
+
+
+'''
+Encoders
+    gzip through zlib (no timestamp in the header, so the same body always
+    compresses to the same bytes), brotli when the package is installed
+    COMPRESS_LEVEL is the gzip level (1-9), COMPRESS_BROTLI_QUALITY the
+    brotli quality (0-11); the defaults favour speed, these bodies are
+    compressed while the client waits
+'''
+
+
+def _gzip(data):
+    compressor = zlib.compressobj(current_app.config['COMPRESS_LEVEL'],
+                                  zlib.DEFLATED, 31)
+    return compressor.compress(data) + compressor.flush()
+
+
+def _brotli(data):
+    return brotli.compress(
+        data, quality=current_app.config['COMPRESS_BROTLI_QUALITY'])
+
+
+ENCODERS = {'gzip': _gzip}
+if brotli is not None:
+    ENCODERS['br'] = _brotli
+
+
+'''
+Negotiation
+    the client's preferred coding among COMPRESS_ENCODINGS (in that order
+    of preference on equal quality values), None for identity
+'''
+
+
+def negotiate():
+    offered = current_app.config['COMPRESS_ENCODINGS']
+    return request.accept_encodings.best_match(offered)
+
+
+'''
+Middleware
+    compresses 200 responses of COMPRESS_MIMETYPES once they reach
+    COMPRESS_MIN_SIZE bytes, below that the framing costs more than it
+    saves; streamed responses are sent as they are
+    every compressible response gets Vary: Accept-Encoding so shared caches
+    keep the codings apart
+    when the body came from (or went into) the response cache the
+    compressed body is stored next to it, later hits reuse it
+'''
+
+
+def _compressed(response, encoding):
+    cached = g.get('cache_entry')
+    if cached is None:
+        return ENCODERS[encoding](response.get_data())
+
+    key, entry, tags = cached
+    body = entry.variants.get(encoding)
+    if body is None:
+        body = ENCODERS[encoding](entry.body)
+        # a new entry, the stored one may be read by other requests and
+        # its size is what the backend accounted for
+        variants = dict(entry.variants)
+        variants[encoding] = body
+        cache = get_cache()
+        if cache is not None:
+            cache.set(key, CachedResponse(entry.body, entry.mimetype,
+                                          variants), tags)
+    return body
+
+
+def _compress(response):
+    if response.status_code != 200 or response.is_streamed \
+            or response.direct_passthrough \
+            or response.mimetype not in COMPRESS_MIMETYPES:
+        return response
+
+    response.vary.add('Accept-Encoding')
+    if 'Content-Encoding' in response.headers or \
+            response.calculate_content_length() < \
+            current_app.config['COMPRESS_MIN_SIZE']:
+        return response
+
+    encoding = negotiate()
+    if encoding is None:
+        return response
+
+    with phase('compress'):
+        response.set_data(_compressed(response, encoding))
+    response.headers['Content-Encoding'] = encoding
+    return response
+
+
+'''
+init_compression(app)
+    COMPRESS_ENCODINGS lists the codings to offer (comma separated, br is
+    dropped when brotli is not installed), empty turns compression off
+    call it after init_instrumentation so the compress phase is timed
+'''
+
+
+def init_compression(app):
+    app.config.setdefault('COMPRESS_ENCODINGS', COMPRESS_ENCODINGS)
+    app.config.setdefault('COMPRESS_MIN_SIZE', COMPRESS_MIN_SIZE)
+    app.config.setdefault('COMPRESS_LEVEL', COMPRESS_LEVEL)
+    app.config.setdefault('COMPRESS_BROTLI_QUALITY', COMPRESS_BROTLI_QUALITY)
+
+    encodings = app.config['COMPRESS_ENCODINGS']
+    if isinstance(encodings, str):
+        encodings = [encoding.strip() for encoding in encodings.split(',')
+                     if encoding.strip()]
+    unknown = set(encodings) - {'br', 'gzip'}
+    if unknown:
+        raise ValueError('unknown COMPRESS_ENCODINGS {}'.format(
+            ', '.join(sorted(unknown))))
+    app.config['COMPRESS_ENCODINGS'] = [encoding for encoding in encodings
+                                        if encoding in ENCODERS]
+    if app.config['COMPRESS_ENCODINGS']:
+        app.after_request(_compress)
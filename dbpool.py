@@ -0,0 +1,132 @@
+import os
+import threading
+import time
+from sqlalchemy import exc
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.pool import QueuePool
+
+
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 5))
+DB_MAX_OVERFLOW = int(os.environ.get('DB_MAX_OVERFLOW', 10))
+DB_POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', 30))
+DB_POOL_RECYCLE = int(os.environ.get('DB_POOL_RECYCLE', 1800))
+DB_POOL_PRE_PING = os.environ.get('DB_POOL_PRE_PING', 'true').lower() \
+    in ('1', 'true', 'yes')
+
+
+'''
+PoolStats
+    checkout counters for one pool: how many connections were handed out,
+    how long callers waited for them and how many gave up after the pool
+    timeout
+'''
+
+
+class PoolStats:
+    def __init__(self):
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+        self._lock = threading.Lock()
+
+    def record(self, seconds, timed_out=False):
+        with self._lock:
+            if timed_out:
+                self.timeouts += 1
+            else:
+                self.checkouts += 1
+            self.wait_seconds += seconds
+            self.max_wait_seconds = max(self.max_wait_seconds, seconds)
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'checkouts': self.checkouts,
+                'timeouts': self.timeouts,
+                'wait_seconds_total': round(self.wait_seconds, 6),
+                'wait_seconds_max': round(self.max_wait_seconds, 6)
+            }
+
+
+'''
+TimedQueuePool
+    QueuePool that times every checkout (including the wait for a free
+    connection when the pool and its overflow are exhausted)
+    the counters survive recreate(), which the engine calls on dispose
+'''
+
+
+class TimedQueuePool(QueuePool):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.stats = PoolStats()
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            connection = super()._do_get()
+        except exc.TimeoutError:
+            self.stats.record(time.perf_counter() - start, timed_out=True)
+            raise
+        self.stats.record(time.perf_counter() - start)
+        return connection
+
+    def recreate(self):
+        pool = super().recreate()
+        pool.stats = self.stats
+        return pool
+
+
+'''
+engine_options(app, database_path)
+    SQLALCHEMY_ENGINE_OPTIONS for the database, from the DB_POOL_* config
+    keys (which default to the environment variables of the same name)
+    pre-ping and recycle drop connections Postgres closed under us (e.g.
+    after a restart) instead of failing the request that checks them out
+    SQLite keeps Flask-SQLAlchemy's pool, only pre-ping applies there
+'''
+
+
+def engine_options(app, database_path):
+    app.config.setdefault('DB_POOL_SIZE', DB_POOL_SIZE)
+    app.config.setdefault('DB_MAX_OVERFLOW', DB_MAX_OVERFLOW)
+    app.config.setdefault('DB_POOL_TIMEOUT', DB_POOL_TIMEOUT)
+    app.config.setdefault('DB_POOL_RECYCLE', DB_POOL_RECYCLE)
+    app.config.setdefault('DB_POOL_PRE_PING', DB_POOL_PRE_PING)
+
+    options = {'pool_pre_ping': app.config['DB_POOL_PRE_PING']}
+    if make_url(database_path).get_backend_name() == 'sqlite':
+        return options
+
+    options.update({
+        'poolclass': TimedQueuePool,
+        'pool_size': app.config['DB_POOL_SIZE'],
+        'max_overflow': app.config['DB_MAX_OVERFLOW'],
+        'pool_timeout': app.config['DB_POOL_TIMEOUT'],
+        'pool_recycle': app.config['DB_POOL_RECYCLE']
+    })
+    return options
+
+
+'''
+pool_status(pool)
+    current occupancy of a pool plus its checkout counters, what
+    GET /db/pool reports
+'''
+
+
+def pool_status(pool):
+    status = {'class': type(pool).__name__}
+    if isinstance(pool, QueuePool):
+        status.update({
+            'size': pool.size(),
+            'max_overflow': pool._max_overflow,
+            'timeout': pool._timeout,
+            'checked_out': pool.checkedout(),
+            'checked_in': pool.checkedin(),
+            'overflow': max(pool.overflow(), 0)
+        })
+    if isinstance(pool, TimedQueuePool):
+        status.update(pool.stats.snapshot())
+    return status
@@ -0,0 +1,50 @@
+import multiprocessing
+import os
+
+
+'''
+gunicorn settings, read by `gunicorn -c gunicorn.conf.py app:app` (see the
+Procfile)
+
+GUNICORN_WORKER_CLASS picks the worker model:
+    sync (default) one request per worker at a time
+    gevent every worker serves up to GUNICORN_WORKER_CONNECTIONS
+        concurrent requests as greenlets; sockets (JWKS fetches included)
+        are monkey patched by the worker and psycopg2 is made cooperative
+        with psycogreen, so a slow query or key fetch only parks its own
+        greenlet
+a gevent worker still holds at most DB_POOL_SIZE + DB_MAX_OVERFLOW database
+connections, requests beyond that wait (cooperatively) for a free one, see
+GET /db/pool; keep WEB_CONCURRENCY * (DB_POOL_SIZE + DB_MAX_OVERFLOW)
+under the database's max_connections
+'''
+
+
+bind = '0.0.0.0:{}'.format(os.environ.get('PORT', '8000'))
+
+worker_class = os.environ.get('GUNICORN_WORKER_CLASS', 'sync')
+
+if worker_class == 'gevent':
+    # the work is I/O bound, a couple of workers per core is plenty
+    workers = int(os.environ.get('WEB_CONCURRENCY',
+                                 multiprocessing.cpu_count()))
+else:
+    workers = int(os.environ.get('WEB_CONCURRENCY',
+                                 multiprocessing.cpu_count() * 2 + 1))
+
+worker_connections = int(
+    os.environ.get('GUNICORN_WORKER_CONNECTIONS', 1000))
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 30))
+keepalive = int(os.environ.get('GUNICORN_KEEPALIVE', 5))
+
+# every worker imports the app itself, after the gevent worker has
+# patched the standard library
+preload_app = False
+
+
+def post_fork(server, worker):
+    database_url = os.environ.get('DATABASE_URL', '')
+    if worker_class == 'gevent' and database_url.startswith('postgres'):
+        from psycogreen.gevent import patch_psycopg
+        patch_psycopg()
+        worker.log.info('psycopg2 patched for gevent')
@@ -0,0 +1,261 @@
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from flask import Response, g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from serialization import JSONEncoder
+
+
+SQL_QUERY_WARN = int(os.environ.get('SQL_QUERY_WARN', 20))
+REQUEST_LOG_LEVEL = os.environ.get('REQUEST_LOG_LEVEL', 'INFO').upper()
+METRICS_PERMISSION = os.environ.get('METRICS_PERMISSION', 'read:metrics')
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                   10.0)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+
+logger = logging.getLogger('agency.requests')
+
+
+'''
+Phases
+    g.timings collects the seconds spent per phase of the current request
+    auth_header, jwks and jwt are timed in auth.py, serialize around the
+    json encoding, db by the engine events below
+    everything else (view code, formatting rows) is reported as app
+'''
+
+
+@contextmanager
+def phase(name):
+    if not has_request_context():
+        yield
+        return
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings = g.setdefault('timings', {})
+        timings[name] = timings.get(name, 0.0) + \
+            time.perf_counter() - start
+
+
+'''
+SQL
+    every statement on every engine (primary and replicas) is counted and
+    timed into the current request
+'''
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context,
+                           executemany):
+    conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    started = conn.info['query_started'].pop()
+    if has_request_context():
+        g.sql_queries = g.get('sql_queries', 0) + 1
+        g.sql_seconds = g.get('sql_seconds', 0.0) + \
+            time.perf_counter() - started
+
+
+def _handle_error(exception_context):
+    connection = exception_context.connection
+    if connection is not None and connection.info.get('query_started'):
+        connection.info['query_started'].pop()
+
+
+event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+event.listen(Engine, 'handle_error', _handle_error)
+
+
+'''
+TimedJSONEncoder
+    the app's json encoder (see serialization.py), times each encode as
+    the serialize phase
+'''
+
+
+class TimedJSONEncoder(JSONEncoder):
+    def encode(self, o):
+        with phase('serialize'):
+            return super().encode(o)
+
+
+'''
+Metrics
+    minimal Prometheus text format histograms, one set per worker process
+    (each worker exposes its own, scrape them per instance)
+'''
+
+
+def _labels(names, values):
+    if not names:
+        return ''
+    pairs = ','.join('{}="{}"'.format(
+        name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+        for name, value in zip(names, values))
+    return '{' + pairs + '}'
+
+
+class Histogram:
+    def __init__(self, name, description, labelnames, buckets):
+        self.name = name
+        self.description = description
+        self.labelnames = labelnames
+        self.buckets = buckets
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, labels, value):
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = \
+                    [[0] * len(self.buckets), 0, 0.0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][i] += 1
+            series[1] += 1
+            series[2] += value
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.description}',
+                 f'# TYPE {self.name} histogram']
+        names = self.labelnames + ('le',)
+        with self._lock:
+            for labels, (counts, count, total) in sorted(
+                    self._series.items()):
+                for bound, bucket in zip(self.buckets, counts):
+                    lines.append('{}_bucket{} {}'.format(
+                        self.name, _labels(names, labels + (bound,)),
+                        bucket))
+                lines.append('{}_bucket{} {}'.format(
+                    self.name, _labels(names, labels + ('+Inf',)), count))
+                suffix = _labels(self.labelnames, labels)
+                lines.append(f'{self.name}_count{suffix} {count}')
+                lines.append(f'{self.name}_sum{suffix} {total:.6f}')
+        return lines
+
+
+request_duration = Histogram(
+    'http_request_duration_seconds', 'Request latency by route.',
+    ('method', 'route', 'status'), LATENCY_BUCKETS)
+request_queries = Histogram(
+    'http_request_db_queries', 'SQL statements per request by route.',
+    ('method', 'route'), QUERY_COUNT_BUCKETS)
+request_db_duration = Histogram(
+    'http_request_db_duration_seconds', 'SQL time per request by route.',
+    ('method', 'route'), LATENCY_BUCKETS)
+
+histograms = [request_duration, request_queries, request_db_duration]
+
+
+'''
+render_metrics(gauges=())
+    the histograms plus (name, description, value) gauges sampled by the
+    caller (cache and pool state...), in the Prometheus text format
+'''
+
+
+def render_metrics(gauges=()):
+    lines = []
+    for histogram in histograms:
+        lines.extend(histogram.render())
+    for name, description, value in gauges:
+        lines.extend([f'# HELP {name} {description}',
+                      f'# TYPE {name} gauge',
+                      f'{name} {value}'])
+    return Response('\n'.join(lines) + '\n',
+                    mimetype='text/plain; version=0.0.4')
+
+
+'''
+Middleware
+    before_request starts the clock, after_request adds the Server-Timing
+    header, records the metrics and writes one json log line per request
+    (a warning when it ran more than SQL_QUERY_WARN statements, the usual
+    sign of an N+1 loop)
+'''
+
+
+def _ms(seconds):
+    return round(seconds * 1000, 2)
+
+
+def _start_timer():
+    g.request_started = time.perf_counter()
+
+
+def _finish_timer(response):
+    started = g.get('request_started')
+    if started is None:
+        return response
+
+    total = time.perf_counter() - started
+    timings = dict(g.get('timings', {}))
+    queries = g.get('sql_queries', 0)
+    timings['db'] = g.get('sql_seconds', 0.0)
+    timings['app'] = max(total - sum(timings.values()), 0.0)
+
+    entries = []
+    for name, seconds in timings.items():
+        entry = f'{name};dur={_ms(seconds)}'
+        if name == 'db':
+            entry += ';desc="{} {}"'.format(
+                queries, 'query' if queries == 1 else 'queries')
+        entries.append(entry)
+    entries.append(f'total;dur={_ms(total)}')
+    response.headers['Server-Timing'] = ', '.join(entries)
+
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+    method = request.method
+    request_duration.observe((method, route, str(response.status_code)),
+                             total)
+    request_queries.observe((method, route), queries)
+    request_db_duration.observe((method, route), timings['db'])
+
+    level = logging.WARNING if queries > SQL_QUERY_WARN else logging.INFO
+    logger.log(level, json.dumps({
+        'method': method,
+        'path': request.path,
+        'route': route,
+        'status': response.status_code,
+        'duration_ms': _ms(total),
+        'sql_queries': queries,
+        'phases_ms': {name: _ms(seconds)
+                      for name, seconds in timings.items()}
+    }, sort_keys=True))
+    return response
+
+
+'''
+init_instrumentation(app)
+    registers the timing hooks and the timed json encoder, call it before
+    any other after_request hook so the timing one runs last, and after
+    init_serialization
+    METRICS_PERMISSION is the permission GET /metrics asks for, give it to
+    the scraper's machine to machine client rather than a user role
+'''
+
+
+def init_instrumentation(app):
+    app.config.setdefault('METRICS_PERMISSION', METRICS_PERMISSION)
+    app.json_encoder = TimedJSONEncoder
+    app.before_request(_start_timer)
+    app.after_request(_finish_timer)
+    if not logger.handlers:
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        logger.addHandler(handler)
+        logger.setLevel(REQUEST_LOG_LEVEL)
+        logger.propagate = False
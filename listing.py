@@ -0,0 +1,467 @@
+import base64
+import binascii
+import operator
+import os
+import time
+from flask import Response, abort, json, stream_with_context
+from sqlalchemy import Date, Integer, and_, func, or_, select, text
+
+from models import CASTING_COLUMNS, castings, db, parse_date
+
+
+DEFAULT_PAGE_SIZE = int(os.environ.get('DEFAULT_PAGE_SIZE', 50))
+MAX_PAGE_SIZE = int(os.environ.get('MAX_PAGE_SIZE', 500))
+STREAM_BATCH_SIZE = int(os.environ.get('STREAM_BATCH_SIZE', 1000))
+UNINDEXED_SORT_MAX_ROWS = int(
+    os.environ.get('UNINDEXED_SORT_MAX_ROWS', 10000))
+
+STREAM_MIMETYPES = {
+    'json': 'application/json',
+    'ndjson': 'application/x-ndjson'
+}
+
+TRUTHY = ('1', 'true', 'yes')
+
+
+'''
+List endpoints read through SQLAlchemy Core: select() only the requested
+columns and build plain dicts from the row tuples, skipping ORM object
+hydration and the identity map entirely
+'''
+
+
+'''
+Cursors
+    opaque, url safe tokens for keyset pagination
+    a cursor is the base64 encoded json of the last row's sort key (the
+    sort column value and id), so the next page is an index range scan
+    instead of an OFFSET that has to walk every skipped row
+'''
+
+
+def encode_cursor(values):
+    raw = json.dumps(values, separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor):
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        values = json.loads(base64.urlsafe_b64decode(padded))
+    except (binascii.Error, ValueError):
+        abort(400)
+
+    if not isinstance(values, dict):
+        abort(400)
+    return values
+
+
+'''
+parse_limit(args)
+    reads ?limit= from the query string, defaults to DEFAULT_PAGE_SIZE
+    aborts with 400 unless 1 <= limit <= MAX_PAGE_SIZE
+'''
+
+
+def parse_limit(args):
+    limit = args.get('limit', DEFAULT_PAGE_SIZE)
+    try:
+        limit = int(limit)
+    except (TypeError, ValueError):
+        abort(400)
+
+    if limit < 1 or limit > MAX_PAGE_SIZE:
+        abort(400)
+    return limit
+
+
+'''
+wants_all(args)
+    the unpaginated listing is opt-in through ?all=true
+'''
+
+
+def wants_all(args):
+    return args.get('all', '').lower() in TRUTHY
+
+
+'''
+select_columns(table, args)
+    reads the comma separated ?fields= from the query string
+    id is always selected (and first) since cursors are built from it
+    return every column of table when ?fields= is absent
+    aborts with 400 on an unknown field
+'''
+
+
+def select_columns(table, args):
+    fields = args.get('fields')
+    if not fields:
+        return list(table.columns)
+
+    names = ['id']
+    for name in fields.split(','):
+        name = name.strip()
+        if name not in table.columns:
+            abort(400)
+        if name not in names:
+            names.append(name)
+    return [table.columns[name] for name in names]
+
+
+'''
+FILTERS
+    query string filters per table: parameter -> (column, comparison)
+    every filtered column carries a B-tree index (see the models)
+'''
+
+
+FILTERS = {
+    'actors': {
+        'name': ('name', operator.eq),
+        'gender': ('gender', operator.eq),
+        'min_age': ('age', operator.ge),
+        'max_age': ('age', operator.le)
+    },
+    'movies': {
+        'title': ('title', operator.eq),
+        'released_after': ('release_date', operator.ge),
+        'released_before': ('release_date', operator.le)
+    }
+}
+
+
+'''
+_coerce(column, value)
+    a query string or cursor value as the type of its column
+    aborts with 400 on anything the column could not be compared to:
+    non-scalar values, integers outside the 32 bit range of an Integer
+    column, strings that are not dates
+'''
+
+
+INTEGER_MIN = -2 ** 31
+INTEGER_MAX = 2 ** 31 - 1
+
+
+def _in_integer_range(value):
+    return INTEGER_MIN <= value <= INTEGER_MAX
+
+
+def _coerce(column, value):
+    if isinstance(column.type, Integer):
+        if type(value) not in (int, str):
+            abort(400)
+        try:
+            value = int(value)
+        except ValueError:
+            abort(400)
+        if not _in_integer_range(value):
+            abort(400)
+        return value
+
+    if type(value) is not str:
+        abort(400)
+    if isinstance(column.type, Date):
+        try:
+            return parse_date(value)
+        except ValueError:
+            abort(400)
+    return value
+
+
+'''
+filter_clauses(table, args)
+    the WHERE clauses for the FILTERS present in the query string
+    aborts with 400 when a value does not fit its column
+'''
+
+
+def filter_clauses(table, args):
+    clauses = []
+    for param, (name, compare) in FILTERS.get(table.name, {}).items():
+        value = args.get(param)
+        if value is not None:
+            column = table.c[name]
+            clauses.append(compare(column, _coerce(column, value)))
+    return clauses
+
+
+'''
+Sort guard
+    sorting a large table on a column without an index means a full sort
+    per request, so those sorts are refused once the table holds more than
+    UNINDEXED_SORT_MAX_ROWS rows
+    the row estimate comes from pg_class on Postgres and a count elsewhere,
+    cached for ROW_ESTIMATE_TTL seconds
+'''
+
+
+ROW_ESTIMATE_TTL = 60
+_row_estimates = {}
+
+
+def is_indexed(column):
+    if column.primary_key or column.index:
+        return True
+    return any(index.columns.values()[0] is column
+               for index in column.table.indexes)
+
+
+def estimate_rows(table):
+    cached = _row_estimates.get(table.name)
+    if cached is not None and time.monotonic() - cached[1] < ROW_ESTIMATE_TTL:
+        return cached[0]
+
+    if db.session.get_bind().dialect.name == 'postgresql':
+        estimate = db.session.execute(
+            text('SELECT reltuples FROM pg_class WHERE relname = :name'),
+            {'name': table.name}).scalar() or 0
+    else:
+        estimate = db.session.execute(
+            select([func.count()]).select_from(table)).scalar()
+
+    _row_estimates[table.name] = (int(estimate), time.monotonic())
+    return int(estimate)
+
+
+'''
+parse_sort(table, args)
+    reads ?sort=column or ?sort=-column (descending), defaults to id
+    return the sort column and whether it is descending
+    aborts with 400 on an unknown column or a guarded unindexed sort
+'''
+
+
+def parse_sort(table, args):
+    sort = args.get('sort', 'id')
+    descending = sort.startswith('-')
+    name = sort[1:] if descending else sort
+    if name not in table.columns:
+        abort(400)
+
+    column = table.columns[name]
+    if not is_indexed(column) and \
+            estimate_rows(table) > UNINDEXED_SORT_MAX_ROWS:
+        abort(400)
+    return column, descending
+
+
+def _order_by(table, column, descending):
+    # ascending sorts put NULLs last and descending ones first, the exact
+    # reverse of each other, which is also the Postgres B-tree order
+    if column is table.c.id:
+        return [column.desc() if descending else column.asc()]
+    if descending:
+        return [column.desc().nullsfirst(), table.c.id.desc()]
+    return [column.asc().nullslast(), table.c.id.asc()]
+
+
+def _after(table, column, descending, value, last_id):
+    id_column = table.c.id
+    if column is id_column:
+        return id_column < last_id if descending else id_column > last_id
+
+    if descending:
+        if value is None:
+            return or_(and_(column.is_(None), id_column < last_id),
+                       column.isnot(None))
+        return or_(column < value,
+                   and_(column == value, id_column < last_id))
+
+    if value is None:
+        return and_(column.is_(None), id_column > last_id)
+    return or_(column > value,
+               and_(column == value, id_column > last_id),
+               column.is_(None))
+
+
+'''
+build_select(table, columns, args)
+    the filtered and sorted select() shared by every list mode
+    the sort column is added to columns when ?fields= left it out
+    return the statement, the selected columns and the (column, descending)
+    sort
+'''
+
+
+def build_select(table, columns, args):
+    sort_column, descending = parse_sort(table, args)
+    if sort_column not in columns:
+        columns = columns + [sort_column]
+
+    stmt = select(columns)
+    for clause in filter_clauses(table, args):
+        stmt = stmt.where(clause)
+    stmt = stmt.order_by(*_order_by(table, sort_column, descending))
+    return stmt, columns, (sort_column, descending)
+
+
+def _as_dicts(columns, rows):
+    keys = [column.key for column in columns]
+    return [dict(zip(keys, row)) for row in rows]
+
+
+'''
+fetch_all(table, columns, args)
+    every matching row, as dicts of the selected columns
+'''
+
+
+def fetch_all(table, columns, args):
+    stmt, columns, _ = build_select(table, columns, args)
+    return _as_dicts(columns, db.session.execute(stmt))
+
+
+'''
+paginate(table, columns, args)
+    applies ?after= and ?limit= as a keyset range on the sort column and id
+    a cursor only continues the sort it was issued for
+    fetches one extra row to know whether another page exists
+    return the rows of the page as dicts and the cursor for the next page
+        (None on the last page)
+'''
+
+
+def paginate(table, columns, args):
+    limit = parse_limit(args)
+    stmt, columns, (sort_column, descending) = \
+        build_select(table, columns, args)
+    sort = args.get('sort', 'id')
+
+    after = args.get('after')
+    if after:
+        cursor = decode_cursor(after)
+        last_id = cursor.get('id')
+        if type(last_id) is not int or not _in_integer_range(last_id) \
+                or cursor.get('sort', 'id') != sort:
+            abort(400)
+        value = cursor.get('value')
+        if value is not None:
+            value = _coerce(sort_column, value)
+        stmt = stmt.where(
+            _after(table, sort_column, descending, value, last_id))
+
+    rows = _as_dicts(columns, db.session.execute(stmt.limit(limit + 1)))
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        last = {'id': rows[-1]['id']}
+        if sort != 'id':
+            last['sort'] = sort
+            last['value'] = rows[-1][sort_column.key]
+        next_cursor = encode_cursor(last)
+    return rows, next_cursor
+
+
+'''
+EMBEDS
+    related rows a listing can nest with ?embed=: name -> the table whose
+    rows are nested (joined through castings)
+'''
+
+
+EMBEDS = {
+    'actors': {'movies': 'movies'},
+    'movies': {'cast': 'actors'}
+}
+
+EMBED_CHUNK = 1000
+
+
+'''
+embed_related(table, rows, args)
+    nests the ?embed= relation under each row, e.g. /movies?embed=cast adds
+    the cast of every movie on the page
+    one query per EMBED_CHUNK rows whatever the page size, never one per
+    row
+    aborts with 400 on an unknown relation
+'''
+
+
+def embed_related(table, rows, args):
+    name = args.get('embed')
+    if not name:
+        return rows
+    if name not in EMBEDS.get(table.name, {}):
+        abort(400)
+
+    other = db.metadata.tables[EMBEDS[table.name][name]]
+    owner_column = CASTING_COLUMNS[table.name]
+    other_column = CASTING_COLUMNS[other.name]
+    keys = [column.key for column in other.columns]
+
+    nested = {row['id']: [] for row in rows}
+    ids = list(nested)
+    for start in range(0, len(ids), EMBED_CHUNK):
+        stmt = select([owner_column] + list(other.columns)) \
+            .select_from(castings.join(other, other_column == other.c.id)) \
+            .where(owner_column.in_(ids[start:start + EMBED_CHUNK])) \
+            .order_by(owner_column, other.c.id)
+        for row in db.session.execute(stmt):
+            nested[row[0]].append(dict(zip(keys, row[1:])))
+
+    for row in rows:
+        row[name] = nested[row['id']]
+    return rows
+
+
+'''
+stream_format(args)
+    reads ?stream= from the query string
+    return 'json', 'ndjson' or None when the client did not ask to stream
+'''
+
+
+def stream_format(args):
+    fmt = args.get('stream')
+    if fmt is None:
+        return None
+    if fmt not in STREAM_MIMETYPES:
+        abort(400)
+    return fmt
+
+
+'''
+stream_rows(table, columns, args, key, fmt)
+    full export of the matching rows without holding them in memory
+    rows are read in STREAM_BATCH_SIZE batches through a server side
+    cursor (stream_results) and each one is encoded as soon as it is read
+    'json' keeps the usual {"success": true, key: [...]} envelope, 'ndjson'
+    writes one object per line
+    ?embed= is not supported while streaming (400)
+'''
+
+
+def stream_rows(table, columns, args, key, fmt):
+    if args.get('embed'):
+        abort(400)
+    stmt, columns, _ = build_select(table, columns, args)
+    stmt = stmt.execution_options(stream_results=True)
+    keys = [column.key for column in columns]
+
+    def rows():
+        result = db.session.execute(stmt)
+        while True:
+            batch = result.fetchmany(STREAM_BATCH_SIZE)
+            if not batch:
+                break
+            for row in batch:
+                yield dict(zip(keys, row))
+
+    def generate_ndjson():
+        for row in rows():
+            yield json.dumps(row) + '\n'
+
+    def generate_json():
+        yield '{"success": true, "%s": [' % key
+        separator = ''
+        for row in rows():
+            yield separator + json.dumps(row)
+            separator = ','
+        yield ']}'
+
+    generate = generate_ndjson if fmt == 'ndjson' else generate_json
+    return Response(stream_with_context(generate()),
+                    mimetype=STREAM_MIMETYPES[fmt])
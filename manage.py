@@ -1,8 +1,9 @@
-from flask_script import Manager
+from flask_script import Command, Manager
 from flask_migrate import Migrate, MigrateCommand
 
 from app import app
 from models import db
+from stats import SUMMARY_COLUMNS, refresh_summary
 
 migrate = Migrate(app, db)
 manager = Manager(app)
@@ -10,5 +11,16 @@ manager = Manager(app)
 manager.add_command('db', MigrateCommand)
 
 
+class RefreshStats(Command):
+    """Rebuild the GET /stats summary from the tables"""
+
+    def run(self):
+        for table_name in SUMMARY_COLUMNS:
+            refresh_summary(table_name)
+
+
+manager.add_command('refresh_stats', RefreshStats())
+
+
 if __name__ == '__main__':
     manager.run()
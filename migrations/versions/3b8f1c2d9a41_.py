@@ -0,0 +1,36 @@
+"""add table_versions
+
+Revision ID: 3b8f1c2d9a41
+Revises: 145420a17771
+Create Date: 2026-10-17 09:12:44.508213
+
+"""
+from datetime import datetime
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3b8f1c2d9a41'
+down_revision = '145420a17771'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    table_versions = op.create_table('table_versions',
+    sa.Column('table_name', sa.String(), nullable=False),
+    sa.Column('version', sa.Integer(), nullable=False),
+    sa.Column('updated_at', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('table_name')
+    )
+    now = datetime.utcnow()
+    op.bulk_insert(table_versions, [
+        {'table_name': 'actors', 'version': 1, 'updated_at': now},
+        {'table_name': 'movies', 'version': 1, 'updated_at': now},
+    ])
+
+
+def downgrade():
+    op.drop_table('table_versions')
@@ -0,0 +1,59 @@
+"""full text search indexes
+
+Revision ID: c51a0e9b2f67
+Revises: 8d2e6f4a7c13
+Create Date: 2026-10-17 11:40:05.392871
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c51a0e9b2f67'
+down_revision = '8d2e6f4a7c13'
+branch_labels = None
+depends_on = None
+
+
+SEARCH_COLUMNS = {'actors': 'name', 'movies': 'title'}
+
+
+def upgrade():
+    dialect = op.get_bind().dialect.name
+    for table, column in SEARCH_COLUMNS.items():
+        if dialect == 'postgresql':
+            op.execute(
+                f"CREATE INDEX ix_{table}_{column}_tsv ON {table} "
+                f"USING gin (to_tsvector('simple', coalesce({column}, '')))")
+        elif dialect == 'sqlite':
+            op.execute(
+                f"CREATE VIRTUAL TABLE {table}_fts USING fts5("
+                f"{column}, content='{table}', content_rowid='id')")
+            op.execute(
+                f"CREATE TRIGGER {table}_fts_insert AFTER INSERT ON {table} "
+                f"BEGIN INSERT INTO {table}_fts(rowid, {column}) "
+                f"VALUES (new.id, new.{column}); END")
+            op.execute(
+                f"CREATE TRIGGER {table}_fts_delete AFTER DELETE ON {table} "
+                f"BEGIN INSERT INTO {table}_fts({table}_fts, rowid, {column}) "
+                f"VALUES ('delete', old.id, old.{column}); END")
+            op.execute(
+                f"CREATE TRIGGER {table}_fts_update AFTER UPDATE ON {table} "
+                f"BEGIN INSERT INTO {table}_fts({table}_fts, rowid, {column}) "
+                f"VALUES ('delete', old.id, old.{column}); "
+                f"INSERT INTO {table}_fts(rowid, {column}) "
+                f"VALUES (new.id, new.{column}); END")
+            op.execute(
+                f"INSERT INTO {table}_fts({table}_fts) VALUES ('rebuild')")
+
+
+def downgrade():
+    dialect = op.get_bind().dialect.name
+    for table, column in SEARCH_COLUMNS.items():
+        if dialect == 'postgresql':
+            op.execute(f"DROP INDEX ix_{table}_{column}_tsv")
+        elif dialect == 'sqlite':
+            for trigger in ('insert', 'delete', 'update'):
+                op.execute(f"DROP TRIGGER {table}_fts_{trigger}")
+            op.execute(f"DROP TABLE {table}_fts")
@@ -1,25 +1,295 @@
-from sqlalchemy import Column, String, Integer, Date, create_engine
+from sqlalchemy import Column, String, Integer, Date, DateTime, ForeignKey
+from sqlalchemy import create_engine
+from sqlalchemy import DDL, and_, event, select
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy.orm import relationship
+from alembic.migration import MigrationContext
+from alembic.script import ScriptDirectory
+from datetime import date, datetime
+from dateutil import parser as date_parser
 import json
 import os
 
-database_path = os.environ['DATABASE_URL']
+from dbpool import engine_options
+from replicas import RoutingSQLAlchemy, init_replicas, record_write
 
-db = SQLAlchemy()
+MIGRATIONS_DIRECTORY = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), 'migrations')
+
+DB_STARTUP_MODES = ('verify', 'create', 'none')
+
+db = RoutingSQLAlchemy()
 
 '''
 setup_db(app)
     binds a flask application and a SQLAlchemy service
+    the database url comes from database_path, the app's
+    SQLALCHEMY_DATABASE_URI or DATABASE_URL, in that order
+    the connection pool is sized from the DB_POOL_* settings, see
+    dbpool.engine_options
+    read replicas come from DATABASE_REPLICA_URLS, see replicas.py
+    DB_STARTUP_MODE decides what happens to the schema:
+        verify (default) trusts the migrations and checks the database
+            revision once, before the first request, without connecting
+            at startup
+        create runs db.create_all() right away (local development, tests)
+        none skips both
 '''
 
 
-def setup_db(app, database_path=database_path):
+def setup_db(app, database_path=None):
+    database_path = database_path or \
+        app.config.get("SQLALCHEMY_DATABASE_URI") or \
+        os.environ['DATABASE_URL']
     app.config["SQLALCHEMY_DATABASE_URI"] = database_path
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = engine_options(
+        app, database_path)
+    app.config.setdefault(
+        'DB_STARTUP_MODE', os.environ.get('DB_STARTUP_MODE', 'verify'))
     db.app = app
     db.init_app(app)
-    # db.drop_all()
-    db.create_all()
+    init_replicas(app, engine_options)
+
+    mode = app.config['DB_STARTUP_MODE']
+    if mode not in DB_STARTUP_MODES:
+        raise ValueError(f'unknown DB_STARTUP_MODE {mode}')
+    if mode == 'create':
+        with app.app_context():
+            db.create_all()
+    elif mode == 'verify':
+        app.before_first_request(verify_schema)
+
+
+'''
+verify_schema()
+    compares the database's alembic revision with the head of the
+    migrations, raises RuntimeError when the database is behind
+    a revision this code does not know is taken to be newer (a migration
+    applied ahead of a rolling deploy) and accepted
+'''
+
+
+def verify_schema():
+    with db.engine.connect() as connection:
+        current = MigrationContext.configure(connection) \
+            .get_current_revision()
+
+    script = ScriptDirectory(MIGRATIONS_DIRECTORY)
+    head = script.get_current_head()
+    known = {revision.revision for revision in script.walk_revisions()}
+    if current == head or (current is not None and current not in known):
+        return
+    raise RuntimeError(
+        f'database schema is at revision {current}, expected {head}: '
+        'run "python manage.py db upgrade"')
+
+
+'''
+TableVersion
+    one row per table, bumped in the same transaction as every write to
+    that table so readers can tell whether anything changed without
+    touching the rows themselves
+'''
+
+
+class TableVersion(db.Model):
+    __tablename__ = 'table_versions'
+
+    table_name = Column(String, primary_key=True)
+    version = Column(Integer, nullable=False, default=0)
+    updated_at = Column(DateTime, nullable=False)
+
+
+'''
+bump_version(table_name)
+    increments the table's version and stamps updated_at
+    runs inside the caller's transaction, the caller commits
+'''
+
+
+def bump_version(table_name):
+    versions = TableVersion.__table__
+    now = datetime.utcnow()
+    result = db.session.execute(
+        versions.update()
+        .where(versions.c.table_name == table_name)
+        .values(version=versions.c.version + 1, updated_at=now))
+    if result.rowcount == 0:
+        db.session.execute(versions.insert().values(
+            table_name=table_name, version=1, updated_at=now))
+
+
+'''
+StatsSummary
+    materialised counts behind GET /stats in summary mode, one row per
+    (metric, bucket), see stats.py
+'''
+
+
+class StatsSummary(db.Model):
+    __tablename__ = 'stats_summary'
+
+    metric = Column(String, primary_key=True)
+    bucket = Column(String, primary_key=True)
+    count = Column(Integer, nullable=False, default=0)
+
+
+'''
+write_listeners
+    callables run with the table name after a write to that table has
+    been committed (e.g. response cache invalidation)
+
+pre_commit_listeners
+    callables run with the written table names inside the write's
+    transaction, after the version bump and before the commit
+
+commit_write(*table_names)
+    bumps the tables' versions, runs pre_commit_listeners, commits and
+    notifies write_listeners
+'''
+
+
+write_listeners = [record_write]
+pre_commit_listeners = []
+
+
+def commit_write(*table_names):
+    for table_name in table_names:
+        bump_version(table_name)
+    for listener in pre_commit_listeners:
+        listener(table_names)
+    db.session.commit()
+    for table_name in table_names:
+        for listener in write_listeners:
+            listener(table_name)
+
+
+'''
+bulk_insert(model, rows)
+    inserts many validated rows in a single transaction
+    on Postgres rows go out as multi-row INSERT ... VALUES ... RETURNING id
+    statements of BULK_INSERT_CHUNK rows, other databases fall back to
+    bulk_insert_mappings
+    return the new ids, in the order of rows
+'''
+
+
+BULK_INSERT_CHUNK = 1000
+
+
+def bulk_insert(model, rows):
+    table = model.__table__
+    ids = []
+    if db.session.get_bind().dialect.name == 'postgresql':
+        for start in range(0, len(rows), BULK_INSERT_CHUNK):
+            chunk = rows[start:start + BULK_INSERT_CHUNK]
+            result = db.session.execute(
+                table.insert().values(chunk).returning(table.c.id))
+            ids.extend(row[0] for row in result)
+    else:
+        mappings = [dict(row) for row in rows]
+        db.session.bulk_insert_mappings(model, mappings, return_defaults=True)
+        ids = [mapping['id'] for mapping in mappings]
+
+    commit_write(table.name)
+    return ids
+
+
+'''
+bulk_update(model, values, ids=None, criteria=None)
+bulk_delete(model, ids=None, criteria=None)
+    set based UPDATE / DELETE ... WHERE id IN (...) over the rows matching
+    ids and / or the column equality criteria, in one transaction
+    on Postgres the affected ids come back through RETURNING, elsewhere
+    they are selected first and the statement is restricted to them
+    return the affected ids
+'''
+
+
+def _target(table, ids, criteria):
+    clauses = []
+    if ids is not None:
+        clauses.append(table.c.id.in_(ids))
+    for name, value in (criteria or {}).items():
+        clauses.append(table.c[name] == value)
+    if not clauses:
+        raise ValueError('ids or a filter are required')
+    return and_(*clauses)
+
+
+def _execute_returning_ids(table, stmt, where):
+    if db.session.get_bind().dialect.name == 'postgresql':
+        result = db.session.execute(
+            stmt.where(where).returning(table.c.id))
+        return sorted(row[0] for row in result)
+
+    ids = sorted(row[0] for row in db.session.execute(
+        select([table.c.id]).where(where)))
+    if ids:
+        db.session.execute(stmt.where(table.c.id.in_(ids)))
+    return ids
+
+
+def bulk_update(model, values, ids=None, criteria=None):
+    table = model.__table__
+    where = _target(table, ids, criteria)
+    ids = _execute_returning_ids(table, table.update().values(values), where)
+    commit_write(table.name)
+    return ids
+
+
+def bulk_delete(model, ids=None, criteria=None):
+    table = model.__table__
+    where = _target(table, ids, criteria)
+    ids = _execute_returning_ids(table, table.delete(), where)
+    # the foreign keys cascade on Postgres, SQLite only enforces them
+    # with PRAGMA foreign_keys so the castings are removed explicitly
+    if ids:
+        db.session.execute(castings.delete().where(
+            CASTING_COLUMNS[table.name].in_(ids)))
+    commit_write(table.name, 'castings')
+    return ids
+
+
+'''
+parse_date(value)
+    dates arrive as ISO strings or as HTTP dates (what jsonify emits for
+    date objects), None stays None
+'''
+
+
+def parse_date(value):
+    if value is None or isinstance(value, date):
+        return value
+    if not isinstance(value, str):
+        raise ValueError('must be a date string')
+    try:
+        return date_parser.parse(value).date()
+    except (ValueError, OverflowError):
+        raise ValueError('must be a date string')
+
+
+'''
+castings
+    association table between actors and movies, a row per actor cast in
+    a movie, removed with either side
+'''
+
+
+castings = db.Table(
+    'castings',
+    Column('movie_id', Integer,
+           ForeignKey('movies.id', ondelete='CASCADE'), primary_key=True),
+    Column('actor_id', Integer,
+           ForeignKey('actors.id', ondelete='CASCADE'), primary_key=True,
+           index=True)
+)
+
+CASTING_COLUMNS = {
+    'actors': castings.c.actor_id,
+    'movies': castings.c.movie_id
+}
 
 
 '''
@@ -32,25 +302,67 @@ class Actor(db.Model):
     __tablename__ = 'actors'
 
     id = Column(Integer(), primary_key=True)
-    name = Column(String)
-    age = Column(Integer)
-    gender = Column(String)
+    name = Column(String, index=True)
+    age = Column(Integer, index=True)
+    gender = Column(String, index=True)
+    movies = relationship('Movie', secondary=castings, order_by='Movie.id',
+                          back_populates='cast')
 
     def __init__(self, name, age, gender):
         self.name = name
         self.age = age
         self.gender = gender
 
+    '''
+    validate(body, partial=False)
+        checks a POST body and returns the constructor arguments
+        with partial=True only the fields present in body are checked and
+        returned (bulk PATCH changes and filters)
+        raises ValueError naming the first invalid field
+    '''
+    @classmethod
+    def validate(cls, body, partial=False):
+        if not isinstance(body, dict):
+            raise ValueError('actor must be an object')
+
+        unknown = set(body) - {'name', 'age', 'gender'}
+        if partial and unknown:
+            raise ValueError(f'unknown field {sorted(unknown)[0]}')
+
+        values = {}
+        if not partial or 'name' in body:
+            name = body.get('name', None)
+            if not isinstance(name, str) or not name:
+                raise ValueError('name is required')
+            values['name'] = name
+        if not partial or 'age' in body:
+            age = body.get('age', None)
+            if age is not None:
+                if isinstance(age, bool):
+                    raise ValueError('age must be an integer')
+                try:
+                    age = int(age)
+                except (TypeError, ValueError):
+                    raise ValueError('age must be an integer')
+            values['age'] = age
+        if not partial or 'gender' in body:
+            gender = body.get('gender', None)
+            if gender is not None and not isinstance(gender, str):
+                raise ValueError('gender must be a string')
+            values['gender'] = gender
+
+        return values
+
     def insert(self):
         db.session.add(self)
-        db.session.commit()
+        commit_write(self.__tablename__)
 
     def update(self):
-        db.session.commit()
+        commit_write(self.__tablename__)
 
     def delete(self):
         db.session.delete(self)
-        db.session.commit()
+        commit_write(self.__tablename__, 'castings')
 
     def format(self):
         return {
@@ -71,23 +383,97 @@ class Movie(db.Model):
     __tablename__ = 'movies'
 
     id = Column(Integer, primary_key=True)
-    title = Column(String)
-    release_date = Column(Date)
+    title = Column(String, index=True)
+    release_date = Column(Date, index=True)
+    cast = relationship('Actor', secondary=castings, order_by='Actor.id',
+                        back_populates='movies')
 
     def __init__(self, title, release_date):
         self.title = title
         self.release_date = release_date
 
+    '''
+    validate(body, partial=False)
+        same contract as Actor.validate
+    '''
+    @classmethod
+    def validate(cls, body, partial=False):
+        if not isinstance(body, dict):
+            raise ValueError('movie must be an object')
+
+        unknown = set(body) - {'title', 'release_date'}
+        if partial and unknown:
+            raise ValueError(f'unknown field {sorted(unknown)[0]}')
+
+        values = {}
+        if not partial or 'title' in body:
+            title = body.get('title', None)
+            if not isinstance(title, str) or not title:
+                raise ValueError('title is required')
+            values['title'] = title
+        if not partial or 'release_date' in body:
+            try:
+                values['release_date'] = parse_date(
+                    body.get('release_date', None))
+            except ValueError as e:
+                raise ValueError(f'release_date {e}')
+
+        return values
+
     def insert(self):
         db.session.add(self)
-        db.session.commit()
+        commit_write(self.__tablename__)
 
     def update(self):
-        db.session.commit()
+        commit_write(self.__tablename__)
 
     def delete(self):
         db.session.delete(self)
-        db.session.commit()
+        commit_write(self.__tablename__, 'castings')
+
+    '''
+    add_cast(actor_ids)
+        casts many actors in one transaction, already cast actors are
+        skipped
+        raises ValueError naming an actor id that does not exist
+        return the ids of the newly cast actors
+    '''
+    def add_cast(self, actor_ids):
+        actor_ids = sorted(set(actor_ids))
+        actors = Actor.__table__
+        known = {row[0] for row in db.session.execute(
+            select([actors.c.id]).where(actors.c.id.in_(actor_ids)))}
+        for actor_id in actor_ids:
+            if actor_id not in known:
+                raise ValueError(f'actor {actor_id} does not exist')
+
+        existing = {row[0] for row in db.session.execute(
+            select([castings.c.actor_id]).where(and_(
+                castings.c.movie_id == self.id,
+                castings.c.actor_id.in_(actor_ids))))}
+        added = [actor_id for actor_id in actor_ids
+                 if actor_id not in existing]
+        if not added:
+            # nothing changed, the castings version (and every cached cast
+            # read) stays valid
+            db.session.rollback()
+            return added
+
+        db.session.execute(castings.insert(), [
+            {'movie_id': self.id, 'actor_id': actor_id}
+            for actor_id in added])
+        commit_write('castings')
+        return added
+
+    def remove_cast(self, actor_id):
+        result = db.session.execute(castings.delete().where(and_(
+            castings.c.movie_id == self.id,
+            castings.c.actor_id == actor_id)))
+        if not result.rowcount:
+            db.session.rollback()
+            return 0
+        commit_write('castings')
+        return result.rowcount
 
     def format(self):
         return {
@@ -95,3 +481,51 @@ class Movie(db.Model):
             'title': self.title,
             'release_date': self.release_date
         }
+
+
+'''
+Search indexes
+    full text search over Actor.name and Movie.title (see search.py)
+    on Postgres: GIN indexes over to_tsvector('simple', ...) expressions
+    on SQLite: FTS5 external content tables kept in sync by triggers
+    created alongside the tables by create_all, and by migration
+'''
+
+
+SEARCH_COLUMNS = {'actors': 'name', 'movies': 'title'}
+
+
+def _register_search_ddl(table, column):
+    event.listen(table, 'after_create', DDL(
+        f"CREATE INDEX IF NOT EXISTS ix_{table.name}_{column}_tsv "
+        f"ON {table.name} USING gin "
+        f"(to_tsvector('simple', coalesce({column}, '')))"
+    ).execute_if(dialect='postgresql'))
+
+    for statement in (
+        f"CREATE VIRTUAL TABLE IF NOT EXISTS {table.name}_fts "
+        f"USING fts5({column}, content='{table.name}', content_rowid='id')",
+        f"CREATE TRIGGER IF NOT EXISTS {table.name}_fts_insert "
+        f"AFTER INSERT ON {table.name} BEGIN "
+        f"INSERT INTO {table.name}_fts(rowid, {column}) "
+        f"VALUES (new.id, new.{column}); END",
+        f"CREATE TRIGGER IF NOT EXISTS {table.name}_fts_delete "
+        f"AFTER DELETE ON {table.name} BEGIN "
+        f"INSERT INTO {table.name}_fts({table.name}_fts, rowid, {column}) "
+        f"VALUES ('delete', old.id, old.{column}); END",
+        f"CREATE TRIGGER IF NOT EXISTS {table.name}_fts_update "
+        f"AFTER UPDATE ON {table.name} BEGIN "
+        f"INSERT INTO {table.name}_fts({table.name}_fts, rowid, {column}) "
+        f"VALUES ('delete', old.id, old.{column}); "
+        f"INSERT INTO {table.name}_fts(rowid, {column}) "
+        f"VALUES (new.id, new.{column}); END"):
+        event.listen(table, 'after_create',
+                     DDL(statement).execute_if(dialect='sqlite'))
+
+    event.listen(table, 'after_drop', DDL(
+        f"DROP TABLE IF EXISTS {table.name}_fts"
+    ).execute_if(dialect='sqlite'))
+
+
+_register_search_ddl(Actor.__table__, 'name')
+_register_search_ddl(Movie.__table__, 'title')
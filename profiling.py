@@ -0,0 +1,287 @@
+import cProfile
+import heapq
+import hmac
+import io
+import itertools
+import marshal
+import os
+import pstats
+import random
+import sys
+import threading
+import time
+from collections import Counter
+from flask import current_app, g, request
+
+from listing import TRUTHY
+
+
+PROFILE_ENABLED = os.environ.get('PROFILE_ENABLED', '').lower() in TRUTHY
+PROFILE_SAMPLE_RATE = float(os.environ.get('PROFILE_SAMPLE_RATE', 0.01))
+PROFILE_MODE = os.environ.get('PROFILE_MODE', 'cprofile')
+PROFILE_KEEP = int(os.environ.get('PROFILE_KEEP', 20))
+PROFILE_SAMPLER_INTERVAL = float(
+    os.environ.get('PROFILE_SAMPLER_INTERVAL', 0.005))
+PROFILE_TOKEN = os.environ.get('PROFILE_TOKEN', '')
+PROFILE_PERMISSION = os.environ.get('PROFILE_PERMISSION', 'read:profiles')
+PROFILE_ADMIN_PERMISSION = os.environ.get('PROFILE_ADMIN_PERMISSION',
+                                          'write:profiles')
+
+PROFILE_HEADER = 'X-Profile'
+PROFILE_MODES = ('cprofile', 'sampler')
+
+
+'''
+Profilers
+    cprofile: deterministic, every call of the request thread, served as
+        pstats or as text
+    sampler: a background thread samples the request thread's stack every
+        PROFILE_SAMPLER_INTERVAL seconds, served as collapsed stacks
+        (flamegraph.pl / speedscope input) or as text
+    only one request per worker is profiled at a time, cProfile can not
+    nest and a second profile would only measure the first
+'''
+
+
+class CProfiler:
+    mode = 'cprofile'
+
+    def __init__(self):
+        self._profile = cProfile.Profile()
+
+    def start(self):
+        self._profile.enable()
+
+    def stop(self):
+        self._profile.disable()
+        self._profile.create_stats()
+        return self._profile
+
+
+def _frame_name(frame):
+    code = frame.f_code
+    return '{} ({}:{})'.format(code.co_name,
+                               os.path.basename(code.co_filename),
+                               code.co_firstlineno)
+
+
+def collapse(frame):
+    names = []
+    while frame is not None:
+        names.append(_frame_name(frame))
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+class Sampler:
+    mode = 'sampler'
+
+    def __init__(self, interval=PROFILE_SAMPLER_INTERVAL):
+        self.interval = interval
+        self.stacks = Counter()
+        self._target = threading.get_ident()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            frame = sys._current_frames().get(self._target)
+            if frame is not None:
+                self.stacks[collapse(frame)] += 1
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+        return dict(self.stacks)
+
+
+def _gevent_patched():
+    gevent = sys.modules.get('gevent.monkey')
+    return gevent is not None and gevent.is_module_patched('threading')
+
+
+def make_profiler(mode):
+    # under gevent the sampler thread would be a greenlet that never gets
+    # to run while the request holds the CPU
+    if mode == 'sampler' and not _gevent_patched():
+        return Sampler(current_app.config['PROFILE_SAMPLER_INTERVAL'])
+    return CProfiler()
+
+
+'''
+ProfileStore
+    the worst (slowest) PROFILE_KEEP profiles of the worker
+'''
+
+
+class ProfileStore:
+    def __init__(self, keep=PROFILE_KEEP):
+        self.keep = keep
+        self._heap = []
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def add(self, entry, data):
+        with self._lock:
+            entry['id'] = next(self._ids)
+            item = (entry['duration_ms'], entry['id'], entry, data)
+            if len(self._heap) < self.keep:
+                heapq.heappush(self._heap, item)
+            elif item[0] > self._heap[0][0]:
+                heapq.heapreplace(self._heap, item)
+            return entry['id']
+
+    def entries(self):
+        with self._lock:
+            items = sorted(self._heap, reverse=True)
+        return [entry for _, _, entry, _ in items]
+
+    def get(self, profile_id):
+        with self._lock:
+            for _, _, entry, data in self._heap:
+                if entry['id'] == profile_id:
+                    return entry, data
+        return None
+
+    def clear(self):
+        with self._lock:
+            self._heap = []
+
+
+'''
+Rendering
+    render(entry, data, fmt) returns (body, mimetype), or None when the
+    profile can not be rendered in that format
+'''
+
+
+def _pstats_text(profile):
+    stream = io.StringIO()
+    pstats.Stats(profile, stream=stream).sort_stats('cumulative') \
+        .print_stats(50)
+    return stream.getvalue()
+
+
+def _collapsed_text(stacks):
+    return ''.join(f'{stack} {count}\n' for stack, count
+                   in sorted(stacks.items(), key=lambda item: -item[1]))
+
+
+def render(entry, data, fmt):
+    if entry['mode'] == 'cprofile':
+        if fmt == 'pstats':
+            # the layout pstats.Stats(filename) loads
+            return marshal.dumps(data.stats), 'application/octet-stream'
+        if fmt == 'text':
+            return _pstats_text(data), 'text/plain'
+        return None
+
+    if fmt in ('collapsed', 'text'):
+        return _collapsed_text(data), 'text/plain'
+    return None
+
+
+'''
+Middleware
+    a request is profiled when profiling is on and it wins the
+    PROFILE_SAMPLE_RATE draw, or when it carries X-Profile: PROFILE_TOKEN
+    (whether profiling is on or not)
+    with profiling off and no PROFILE_TOKEN the hook returns after one
+    config lookup
+'''
+
+
+_active = threading.Lock()
+
+
+def _privileged():
+    token = current_app.config['PROFILE_TOKEN']
+    if not token:
+        return False
+    return hmac.compare_digest(request.headers.get(PROFILE_HEADER, ''),
+                               token)
+
+
+def _start_profile():
+    config = current_app.config
+    if not config['PROFILE_ENABLED'] and not config['PROFILE_TOKEN']:
+        return
+    if request.path.startswith('/debug/'):
+        return
+
+    sampled = config['PROFILE_ENABLED'] and \
+        random.random() < config['PROFILE_SAMPLE_RATE']
+    if not sampled and not _privileged():
+        return
+    if not _active.acquire(blocking=False):
+        return
+
+    profiler = make_profiler(config['PROFILE_MODE'])
+    g.profile = (profiler, time.perf_counter())
+    profiler.start()
+
+
+def _stop_profile():
+    profile = g.pop('profile', None)
+    if profile is None:
+        return None
+    profiler, started = profile
+    try:
+        data = profiler.stop()
+    finally:
+        _active.release()
+    return profiler, data, time.perf_counter() - started
+
+
+def _finish_profile(response):
+    stopped = _stop_profile()
+    if stopped is None:
+        return response
+
+    profiler, data, duration = stopped
+    profile_id = current_app.extensions['profiles'].add({
+        'mode': profiler.mode,
+        'method': request.method,
+        'path': request.full_path.rstrip('?'),
+        'route': request.url_rule.rule if request.url_rule else None,
+        'status': response.status_code,
+        'duration_ms': round(duration * 1000, 2),
+        'recorded_at': time.time()
+    }, data)
+    response.headers['X-Profile-Id'] = str(profile_id)
+    return response
+
+
+def _discard_profile(exception):
+    # after_request does not run when the view raised, stop the profiler
+    # all the same
+    _stop_profile()
+
+
+'''
+init_profiling(app)
+    PROFILE_ENABLED, PROFILE_SAMPLE_RATE, PROFILE_MODE and PROFILE_TOKEN
+    can be changed at runtime (PATCH /debug/profiles/config), per worker
+    PROFILE_PERMISSION reads the profiles, PROFILE_ADMIN_PERMISSION changes
+    the settings
+'''
+
+
+def init_profiling(app):
+    app.config.setdefault('PROFILE_ENABLED', PROFILE_ENABLED)
+    app.config.setdefault('PROFILE_SAMPLE_RATE', PROFILE_SAMPLE_RATE)
+    app.config.setdefault('PROFILE_MODE', PROFILE_MODE)
+    app.config.setdefault('PROFILE_KEEP', PROFILE_KEEP)
+    app.config.setdefault('PROFILE_SAMPLER_INTERVAL',
+                          PROFILE_SAMPLER_INTERVAL)
+    app.config.setdefault('PROFILE_TOKEN', PROFILE_TOKEN)
+    app.config.setdefault('PROFILE_PERMISSION', PROFILE_PERMISSION)
+    app.config.setdefault('PROFILE_ADMIN_PERMISSION', PROFILE_ADMIN_PERMISSION)
+
+    app.extensions['profiles'] = ProfileStore(app.config['PROFILE_KEEP'])
+    app.before_request(_start_profile)
+    app.after_request(_finish_profile)
+    app.teardown_request(_discard_profile)
@@ -0,0 +1,219 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from functools import wraps
+from flask import _request_ctx_stack, current_app, g, has_app_context
+from flask import has_request_context, request
+from flask_sqlalchemy import SignallingSession, SQLAlchemy
+from sqlalchemy import create_engine, exc, orm
+
+
+DATABASE_REPLICA_URLS = os.environ.get('DATABASE_REPLICA_URLS', '')
+READ_YOUR_WRITES_SECONDS = float(
+    os.environ.get('READ_YOUR_WRITES_SECONDS', 5))
+REPLICA_RETRY_SECONDS = float(os.environ.get('REPLICA_RETRY_SECONDS', 30))
+
+WRITE_COOKIE = 'last_write'
+
+
+'''
+RoutingSession
+    session whose reads go to the replica picked for the current request
+    (g.replica_engine, set by @read_only), every other statement goes to
+    the primary as before
+'''
+
+
+class RoutingSession(SignallingSession):
+    def get_bind(self, mapper=None, clause=None):
+        replica = g.get('replica_engine') if has_app_context() else None
+        if replica is not None:
+            return replica
+        return super().get_bind(mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+'''
+ReplicaSet
+    the replica engines, handed out round robin
+    a replica whose connection failed is skipped for REPLICA_RETRY_SECONDS
+    return None from choose() when every replica is down
+'''
+
+
+class ReplicaSet:
+    def __init__(self, engines, retry_after=REPLICA_RETRY_SECONDS):
+        self.engines = engines
+        self.retry_after = retry_after
+        self._down_until = {}
+        self._next = 0
+        self._lock = threading.Lock()
+
+    def choose(self):
+        now = time.monotonic()
+        with self._lock:
+            for _ in range(len(self.engines)):
+                engine = self.engines[self._next]
+                self._next = (self._next + 1) % len(self.engines)
+                if self._down_until.get(engine, 0) <= now:
+                    return engine
+        return None
+
+    def mark_down(self, engine):
+        with self._lock:
+            self._down_until[engine] = time.monotonic() + self.retry_after
+
+    def healthy(self, engine):
+        return self._down_until.get(engine, 0) <= time.monotonic()
+
+
+'''
+Read your writes
+    a client that just wrote reads from the primary for
+    READ_YOUR_WRITES_SECONDS, replicas may not have the write yet
+    the worker that took the write remembers it by token subject, and the
+    response sets a short lived last_write cookie so the other workers
+    know as well
+    record_write is one of the models' write_listeners
+'''
+
+
+_recent_writes = OrderedDict()
+_recent_writes_lock = threading.Lock()
+
+
+def _window():
+    return current_app.config['READ_YOUR_WRITES_SECONDS']
+
+
+def _subject():
+    user = getattr(_request_ctx_stack.top, 'current_user', None)
+    if isinstance(user, dict):
+        return user.get('sub')
+    return None
+
+
+def record_write(table_name):
+    if not has_request_context() or \
+            current_app.extensions.get('replicas') is None:
+        return
+
+    g.wrote_at = time.time()
+    subject = _subject()
+    if subject is None:
+        return
+    with _recent_writes_lock:
+        _recent_writes[subject] = g.wrote_at
+        _recent_writes.move_to_end(subject)
+        cutoff = g.wrote_at - _window()
+        while _recent_writes and \
+                next(iter(_recent_writes.values())) < cutoff:
+            _recent_writes.popitem(last=False)
+
+
+def wrote_recently():
+    cutoff = time.time() - _window()
+    try:
+        if float(request.cookies.get(WRITE_COOKIE, 0)) > cutoff:
+            return True
+    except ValueError:
+        pass
+    with _recent_writes_lock:
+        return _recent_writes.get(_subject(), 0) > cutoff
+
+
+def _set_write_cookie(response):
+    wrote_at = g.get('wrote_at')
+    if wrote_at is not None:
+        response.set_cookie(WRITE_COOKIE, repr(wrote_at),
+                            max_age=int(_window()) + 1, httponly=True)
+    return response
+
+
+'''
+@read_only decorator
+    runs a read only view against a replica
+    it should keep the primary when there are no replicas, every replica
+        is down or the client wrote within the read your writes window
+    a connection error on the replica marks it down and the view is run
+        again on the primary
+    goes below @requires_auth so the client's writes can be looked up
+'''
+
+
+def read_only(f):
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        replicas = current_app.extensions.get('replicas')
+        if replicas is None or wrote_recently():
+            return f(*args, **kwargs)
+
+        engine = replicas.choose()
+        if engine is None:
+            return f(*args, **kwargs)
+
+        g.replica_engine = engine
+        try:
+            return f(*args, **kwargs)
+        except (exc.OperationalError, exc.InterfaceError):
+            replicas.mark_down(engine)
+            current_app.extensions['sqlalchemy'].db.session.rollback()
+            g.replica_engine = None
+            return f(*args, **kwargs)
+
+    return wrapper
+
+
+'''
+primary()
+    context manager for the writes a read only view has to make (e.g.
+    rebuilding a summary), they and the reads inside go to the primary
+'''
+
+
+@contextmanager
+def primary():
+    replica = g.pop('replica_engine', None)
+    try:
+        yield
+    finally:
+        if replica is not None:
+            g.replica_engine = replica
+
+
+'''
+init_replicas(app, engine_options)
+    creates an engine per DATABASE_REPLICA_URLS entry (comma separated),
+    pooled like the primary
+    without replicas every query keeps going to DATABASE_URL
+'''
+
+
+def init_replicas(app, engine_options):
+    app.config.setdefault('DATABASE_REPLICA_URLS', DATABASE_REPLICA_URLS)
+    app.config.setdefault('READ_YOUR_WRITES_SECONDS',
+                          READ_YOUR_WRITES_SECONDS)
+    app.config.setdefault('REPLICA_RETRY_SECONDS', REPLICA_RETRY_SECONDS)
+
+    urls = app.config['DATABASE_REPLICA_URLS']
+    if isinstance(urls, str):
+        urls = [url.strip() for url in urls.split(',') if url.strip()]
+
+    replicas = None
+    if urls:
+        replicas = ReplicaSet(
+            [create_engine(url, **engine_options(app, url)) for url in urls],
+            retry_after=app.config['REPLICA_RETRY_SECONDS'])
+        app.after_request(_set_write_cookie)
+    app.extensions['replicas'] = replicas
+    return replicas
+
+
+def get_replicas():
+    return current_app.extensions.get('replicas')
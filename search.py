@@ -0,0 +1,131 @@
+import re
+from flask import _request_ctx_stack, abort
+from sqlalchemy import text
+
+from auth import AuthError, PERMISSION_NOT_FOUND
+from listing import INTEGER_MAX, decode_cursor, encode_cursor, parse_limit
+from models import SEARCH_COLUMNS, db
+
+
+MAX_QUERY_LENGTH = 200
+
+SEARCH_FIELDS = {
+    'actors': ('id', 'name', 'age', 'gender'),
+    'movies': ('id', 'title', 'release_date')
+}
+
+TOKEN = re.compile(r'\w+', re.UNICODE)
+
+
+'''
+Queries
+    every word of ?q= must match, the last one (and every other) as a
+    prefix, so "tom ha" finds "Tom Hanks"
+    Postgres: ranked with ts_rank over the GIN indexed tsvector expression
+    SQLite: ranked with bm25 over the FTS5 table
+    ties are broken by id so offsets are stable between pages
+'''
+
+
+def _postgres_query(table):
+    column = SEARCH_COLUMNS[table]
+    fields = ', '.join(f't.{name}' for name in SEARCH_FIELDS[table])
+    tsvector = f"to_tsvector('simple', coalesce(t.{column}, ''))"
+    return text(
+        f"SELECT {fields} "
+        f"FROM {table} AS t, to_tsquery('simple', :query) AS query "
+        f"WHERE {tsvector} @@ query "
+        f"ORDER BY ts_rank({tsvector}, query) DESC, t.id "
+        f"LIMIT :limit OFFSET :offset")
+
+
+def _sqlite_query(table):
+    fields = ', '.join(f't.{name}' for name in SEARCH_FIELDS[table])
+    return text(
+        f"SELECT {fields} "
+        f"FROM {table}_fts JOIN {table} AS t ON t.id = {table}_fts.rowid "
+        f"WHERE {table}_fts MATCH :query "
+        f"ORDER BY bm25({table}_fts), t.id "
+        f"LIMIT :limit OFFSET :offset")
+
+
+def _match_expression(dialect, tokens):
+    if dialect == 'postgresql':
+        return ' & '.join(f'{token}:*' for token in tokens)
+    return ' '.join(f'"{token}"*' for token in tokens)
+
+
+def search_table(table, tokens, limit, offset):
+    dialect = db.session.get_bind().dialect.name
+    if dialect == 'postgresql':
+        stmt = _postgres_query(table)
+    else:
+        stmt = _sqlite_query(table)
+
+    columns = db.metadata.tables[table].c
+    stmt = stmt.columns(**{name: columns[name].type
+                           for name in SEARCH_FIELDS[table]})
+    result = db.session.execute(stmt, {
+        'query': _match_expression(dialect, tokens),
+        'limit': limit + 1,
+        'offset': offset
+    })
+    keys = SEARCH_FIELDS[table]
+    rows = [dict(zip(keys, row)) for row in result]
+    return rows[:limit], len(rows) > limit
+
+
+'''
+search_catalogue(args)
+    ?q= the words to look for
+    ?type=actors or ?type=movies narrows the search, by default every
+        section the caller may read (get:actors / get:movies) is searched
+    ?limit= page size per section, ?after= the next_cursor of the
+        previous page (it continues every section that has more results)
+    aborts with 400 on an empty or too long query or a malformed cursor,
+    raises a 403 AuthError when ?type= names a section the caller may not
+    read
+'''
+
+
+def search_catalogue(args):
+    query = args.get('q', '')
+    tokens = TOKEN.findall(query.lower())
+    if not tokens or len(query) > MAX_QUERY_LENGTH:
+        abort(400)
+
+    permissions = _request_ctx_stack.top.current_permissions
+    readable = [table for table in SEARCH_FIELDS
+                if f'get:{table}' in permissions]
+    requested = args.get('type')
+    if requested is not None:
+        if requested not in SEARCH_FIELDS:
+            abort(400)
+        if requested not in readable:
+            raise AuthError(PERMISSION_NOT_FOUND, 403)
+        readable = [requested]
+
+    limit = parse_limit(args)
+    offsets = {table: 0 for table in readable}
+    if args.get('after'):
+        cursor = decode_cursor(args['after'])
+        offsets = {table: offset for table, offset in cursor.items()
+                   if table in offsets}
+        if not all(type(offset) is int and 0 <= offset <= INTEGER_MAX
+                   for offset in offsets.values()):
+            abort(400)
+
+    body = {'success': True}
+    next_offsets = {}
+    for table in readable:
+        if table not in offsets:
+            body[table] = []
+            continue
+        rows, more = search_table(table, tokens, limit, offsets[table])
+        body[table] = rows
+        if more:
+            next_offsets[table] = offsets[table] + limit
+
+    body['next_cursor'] = encode_cursor(next_offsets) if next_offsets \
+        else None
+    return body
@@ -0,0 +1,89 @@
+import logging
+import os
+from datetime import date
+from flask import current_app, has_app_context
+from flask.json import JSONDecoder as FlaskJSONDecoder
+from flask.json import JSONEncoder as FlaskJSONEncoder
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+JSON_BACKEND = os.environ.get('JSON_BACKEND', 'auto')
+
+JSON_BACKENDS = ('auto', 'orjson', 'stdlib')
+
+logger = logging.getLogger(__name__)
+
+
+'''
+JSON backends
+    orjson (when installed) encodes and decodes the request and response
+    bodies, the standard library json module otherwise
+    both write dates and datetimes as ISO 8601 ('2020-07-30',
+    '2020-07-30T06:00:00'), so the values do not depend on the backend
+    (orjson writes non-ASCII characters as UTF-8 instead of escaping them)
+    anything orjson rejects (integers wider than 64 bits, NaN in a request
+    body...) goes through the standard library as before, and so do
+    indented (JSONIFY_PRETTYPRINT_REGULAR / debug) responses
+'''
+
+
+def _orjson_enabled():
+    return has_app_context() and \
+        current_app.config.get('JSON_BACKEND') == 'orjson'
+
+
+class JSONEncoder(FlaskJSONEncoder):
+    def default(self, o):
+        if isinstance(o, date):
+            return o.isoformat()
+        return super().default(o)
+
+    def encode(self, o):
+        if self.indent is None and _orjson_enabled():
+            option = orjson.OPT_NON_STR_KEYS
+            if self.sort_keys:
+                option |= orjson.OPT_SORT_KEYS
+            try:
+                return orjson.dumps(o, default=self.default,
+                                    option=option).decode('utf-8')
+            except TypeError:
+                pass
+        return super().encode(o)
+
+
+class JSONDecoder(FlaskJSONDecoder):
+    def decode(self, s, *args, **kwargs):
+        if _orjson_enabled():
+            try:
+                return orjson.loads(s)
+            except orjson.JSONDecodeError:
+                pass
+        return super().decode(s, *args, **kwargs)
+
+
+'''
+init_serialization(app)
+    JSON_BACKEND picks the backend: auto (orjson when it is installed),
+    orjson or stdlib; orjson without the package installed falls back to
+    the standard library with a warning
+    the setting is resolved to orjson or stdlib once, here
+'''
+
+
+def init_serialization(app):
+    app.config.setdefault('JSON_BACKEND', JSON_BACKEND)
+    backend = app.config['JSON_BACKEND']
+    if backend not in JSON_BACKENDS:
+        raise ValueError(f'unknown JSON_BACKEND {backend}')
+
+    if backend == 'orjson' and orjson is None:
+        logger.warning('JSON_BACKEND=orjson but orjson is not installed, '
+                       'using the standard library')
+    app.config['JSON_BACKEND'] = 'orjson' \
+        if backend != 'stdlib' and orjson is not None else 'stdlib'
+    app.json_encoder = JSONEncoder
+    app.json_decoder = JSONDecoder
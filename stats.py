@@ -0,0 +1,402 @@
+import json
+import os
+from flask import _request_ctx_stack, abort, current_app, has_app_context
+from sqlalchemy import Integer, case, cast, event, extract, func, inspect
+from sqlalchemy import literal_column, select
+from sqlalchemy.orm import Session
+
+from auth import AuthError, PERMISSION_NOT_FOUND
+from caching import read_versions
+from listing import TRUTHY
+from models import (Actor, Movie, StatsSummary, TableVersion, db, parse_date,
+                    pre_commit_listeners)
+from replicas import primary
+
+
+STATS_AGE_BUCKET = int(os.environ.get('STATS_AGE_BUCKET', 10))
+STATS_AGE_MAX = int(os.environ.get('STATS_AGE_MAX', 120))
+STATS_SUMMARY = os.environ.get('STATS_SUMMARY', '').lower() in TRUTHY
+
+SUMMARY_MODELS = {Actor: 'actors', Movie: 'movies'}
+
+# columns each summary is built from, writes that leave them alone keep
+# the summary as it is
+SUMMARY_COLUMNS = {
+    'actors': ('age', 'gender'),
+    'movies': ('release_date',)
+}
+
+METRICS = {
+    'actors': ('actors.gender', 'actors.age'),
+    'movies': ('movies.year',)
+}
+
+
+'''
+Aggregates
+    every report is a GROUP BY in the database, only (value, count) pairs
+    cross the wire
+    ages are grouped in buckets of ?age_bucket= years (width_bucket on
+    Postgres, the same arithmetic elsewhere), ages from STATS_AGE_MAX
+    (rounded up to a whole bucket) on share the last bucket
+    constants are inlined so the grouped expression is identical in the
+    select list and the GROUP BY
+'''
+
+
+def _bucket_count(width):
+    return -(-STATS_AGE_MAX // width)
+
+
+def age_bucket(age, width):
+    if age < 0:
+        return -width
+    return min(age // width, _bucket_count(width)) * width
+
+
+def _age_bucket_expression(age, width):
+    buckets = _bucket_count(width)
+    upper = literal_column(str(buckets * width))
+    step = literal_column(str(width))
+    if db.session.get_bind().dialect.name == 'postgresql':
+        bucket = func.width_bucket(age, literal_column('0'), upper,
+                                   literal_column(str(buckets)))
+        return (bucket - literal_column('1')) * step
+    return case([(age < literal_column('0'), -step), (age >= upper, upper)],
+                else_=(age / step) * step)
+
+
+def _release_year_expression(release_date):
+    # EXTRACT is numeric on Postgres 14+ (Decimal) and double precision
+    # before (2020.0), the summary keys are ints
+    return cast(extract('year', release_date), Integer)
+
+
+def _grouped(table, expression):
+    stmt = select([expression, func.count()]).select_from(table) \
+        .group_by(expression)
+    return dict(db.session.execute(stmt).fetchall())
+
+
+def live_counts(table_name, width):
+    if table_name == 'actors':
+        table = Actor.__table__
+        return {
+            'actors.gender': _grouped(table, table.c.gender),
+            'actors.age': _grouped(
+                table, _age_bucket_expression(table.c.age, width))
+        }
+
+    table = Movie.__table__
+    return {
+        'movies.year': _grouped(
+            table, _release_year_expression(table.c.release_date))
+    }
+
+
+'''
+Summary mode
+    with STATS_SUMMARY on, GET /stats reads the stats_summary rows instead
+    of aggregating the tables
+    writes through the model methods (insert / update / delete) adjust the
+    affected counts in their own transaction, from a before_flush hook
+    each summarised table has a '<table>.version' marker row holding the
+    table version the summary matches; ORM writes move it along with the
+    version, bulk writes (set based, no ORM objects) leave it behind and
+    the next read rebuilds that table's summary
+'''
+
+
+def summary_enabled():
+    return has_app_context() and current_app.config.get('STATS_SUMMARY')
+
+
+def _marker(table_name):
+    return f'{table_name}.version'
+
+
+def _summary_keys(table_name, values):
+    if table_name == 'actors':
+        age = values['age']
+        if age is not None:
+            age = age_bucket(int(age), STATS_AGE_BUCKET)
+        return [('actors.gender', values['gender']), ('actors.age', age)]
+
+    release_date = parse_date(values['release_date'])
+    return [('movies.year', release_date.year if release_date else None)]
+
+
+def _values(obj, table_name, previous=False):
+    state = inspect(obj)
+    values = {}
+    for name in SUMMARY_COLUMNS[table_name]:
+        history = state.attrs[name].history
+        if not previous or not history.has_changes():
+            values[name] = getattr(obj, name)
+        elif history.deleted:
+            values[name] = history.deleted[0]
+        else:
+            # changed before it was ever loaded, the old value is unknown
+            raise ValueError(name)
+    return values
+
+
+def _changed(obj, table_name):
+    state = inspect(obj)
+    return any(state.attrs[name].history.has_changes()
+               for name in SUMMARY_COLUMNS[table_name])
+
+
+def _add_delta(deltas, table_name, values, delta):
+    for key in _summary_keys(table_name, values):
+        deltas[key] = deltas.get(key, 0) + delta
+
+
+def _apply_delta(session, metric, value, delta):
+    summary = StatsSummary.__table__
+    bucket = json.dumps(value)
+    result = session.execute(
+        summary.update()
+        .where(summary.c.metric == metric)
+        .where(summary.c.bucket == bucket)
+        .values(count=summary.c.count + delta))
+    if result.rowcount == 0:
+        session.execute(summary.insert().values(
+            metric=metric, bucket=bucket, count=delta))
+
+
+def _count_flush(session, flush_context, instances):
+    if not summary_enabled():
+        return
+
+    counted = session.info.setdefault('stats_counted', set())
+    failed = session.info.setdefault('stats_failed', set())
+    deltas = {}
+    changes = [(obj, 1) for obj in session.new] + \
+        [(obj, -1) for obj in session.deleted] + \
+        [(obj, 0) for obj in session.dirty]
+
+    for obj, delta in changes:
+        table_name = SUMMARY_MODELS.get(type(obj))
+        if table_name is None:
+            continue
+        counted.add(table_name)
+        try:
+            if delta:
+                _add_delta(deltas, table_name,
+                           _values(obj, table_name), delta)
+            elif _changed(obj, table_name):
+                _add_delta(deltas, table_name,
+                           _values(obj, table_name, previous=True), -1)
+                _add_delta(deltas, table_name, _values(obj, table_name), 1)
+        except (TypeError, ValueError):
+            failed.add(table_name)
+
+    for (metric, value), delta in deltas.items():
+        if delta:
+            _apply_delta(session, metric, value, delta)
+
+
+def _clear_marks(session):
+    session.info.pop('stats_counted', None)
+    session.info.pop('stats_failed', None)
+
+
+def _advance_marker(table_name):
+    versions = TableVersion.__table__
+    summary = StatsSummary.__table__
+    version = db.session.execute(
+        select([versions.c.version])
+        .where(versions.c.table_name == table_name)).scalar()
+    db.session.execute(
+        summary.update()
+        .where(summary.c.metric == _marker(table_name))
+        .where(summary.c.count == version - 1)
+        .values(count=version))
+
+
+def _summary_pre_commit(table_names):
+    tables = [name for name in table_names if name in SUMMARY_COLUMNS]
+    if not tables or not summary_enabled():
+        return
+
+    db.session.flush()
+    counted = db.session.info.get('stats_counted', set())
+    failed = db.session.info.get('stats_failed', set())
+    for table_name in tables:
+        if table_name in counted and table_name not in failed:
+            _advance_marker(table_name)
+    _clear_marks(db.session)
+
+
+event.listen(Session, 'before_flush', _count_flush)
+event.listen(Session, 'after_commit', _clear_marks)
+event.listen(Session, 'after_rollback', _clear_marks)
+pre_commit_listeners.append(_summary_pre_commit)
+
+
+'''
+refresh_summary(table_name)
+    rebuilds the table's summary rows from the live aggregates and commits
+    the table's version row is locked first so writes wait for the rebuild
+    (and a rebuild that lost the race to another one does nothing)
+'''
+
+
+def refresh_summary(table_name):
+    versions = TableVersion.__table__
+    summary = StatsSummary.__table__
+    version = db.session.execute(
+        select([versions.c.version])
+        .where(versions.c.table_name == table_name)
+        .with_for_update()).scalar() or 0
+    marker = db.session.execute(
+        select([summary.c.count])
+        .where(summary.c.metric == _marker(table_name))).scalar()
+    if marker == version:
+        db.session.commit()
+        return
+
+    db.session.execute(summary.delete().where(
+        summary.c.metric.like(f'{table_name}.%')))
+    rows = [{'metric': metric, 'bucket': json.dumps(value), 'count': count}
+            for metric, counts in live_counts(
+                table_name, STATS_AGE_BUCKET).items()
+            for value, count in counts.items()]
+    rows.append({'metric': _marker(table_name), 'bucket': '',
+                 'count': version})
+    db.session.execute(summary.insert(), rows)
+    db.session.commit()
+
+
+def _read_summary(table_name):
+    summary = StatsSummary.__table__
+    counts = {metric: {} for metric in METRICS[table_name]}
+    stmt = select([summary.c.metric, summary.c.bucket, summary.c.count]) \
+        .where(summary.c.metric.in_(list(counts))) \
+        .where(summary.c.count > 0)
+    for metric, bucket, count in db.session.execute(stmt):
+        counts[metric][json.loads(bucket)] = count
+    return counts
+
+
+'''
+summary_counts(table_name)
+    the table's summary, rebuilt first when its marker is behind the table
+    version
+    a rebuild (and the read right after it) runs on the primary, a replica
+    would not have the new rows yet
+'''
+
+
+def summary_counts(table_name):
+    summary = StatsSummary.__table__
+    version = read_versions([table_name])[table_name][0]
+    marker = db.session.execute(
+        select([summary.c.count])
+        .where(summary.c.metric == _marker(table_name))).scalar()
+    if marker == version:
+        return _read_summary(table_name)
+
+    with primary():
+        refresh_summary(table_name)
+        return _read_summary(table_name)
+
+
+'''
+Report
+    null groups (unknown gender, age or release date) are listed last
+'''
+
+
+def _nulls_last(item):
+    return (item[0] is None, item[0] if item[0] is not None else 0)
+
+
+def _actors_report(counts, width):
+    genders = counts['actors.gender']
+    ages = counts['actors.age']
+    last = _bucket_count(width) * width
+
+    by_age = []
+    for lower, count in sorted((lower, count) for lower, count
+                               in ages.items() if lower is not None):
+        by_age.append({
+            'from': lower if lower >= 0 else None,
+            'to': lower + width - 1 if lower < last else None,
+            'count': count
+        })
+
+    return {
+        'total': sum(genders.values()),
+        'by_gender': [{'gender': gender, 'count': count} for gender, count
+                      in sorted(genders.items(), key=lambda item: (
+                          item[0] is None, item[0] or ''))],
+        'by_age': by_age,
+        'unknown_age': ages.get(None, 0)
+    }
+
+
+def _movies_report(counts):
+    years = counts['movies.year']
+    return {
+        'total': sum(years.values()),
+        'by_year': [{'year': year, 'count': count} for year, count
+                    in sorted(years.items(), key=_nulls_last)]
+    }
+
+
+'''
+catalogue_stats(args)
+    ?type=actors or ?type=movies narrows the report, by default every
+        section the caller may read (get:actors / get:movies) is included
+    ?age_bucket= width of the age buckets in years, STATS_AGE_BUCKET by
+        default
+    reads the summary when it is enabled and holds the requested buckets,
+    otherwise aggregates the tables
+    aborts with 400 on a bad ?type= or ?age_bucket=, raises a 403 AuthError
+    when ?type= names a section the caller may not read
+'''
+
+
+def catalogue_stats(args):
+    permissions = _request_ctx_stack.top.current_permissions
+    readable = [table for table in SUMMARY_COLUMNS
+                if f'get:{table}' in permissions]
+    requested = args.get('type')
+    if requested is not None:
+        if requested not in SUMMARY_COLUMNS:
+            abort(400)
+        if requested not in readable:
+            raise AuthError(PERMISSION_NOT_FOUND, 403)
+        readable = [requested]
+
+    try:
+        width = int(args.get('age_bucket', STATS_AGE_BUCKET))
+    except ValueError:
+        abort(400)
+    if width < 1 or width > STATS_AGE_MAX:
+        abort(400)
+
+    from_summary = summary_enabled() and width == STATS_AGE_BUCKET
+    body = {'success': True, 'source': 'summary' if from_summary else 'live'}
+    for table_name in readable:
+        if from_summary:
+            counts = summary_counts(table_name)
+        else:
+            counts = live_counts(table_name, width)
+        if table_name == 'actors':
+            body['actors'] = _actors_report(counts, width)
+        else:
+            body['movies'] = _movies_report(counts)
+    return body
+
+
+'''
+init_stats(app)
+    STATS_SUMMARY turns summary mode on
+'''
+
+
+def init_stats(app):
+    app.config.setdefault('STATS_SUMMARY', STATS_SUMMARY)
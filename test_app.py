@@ -1,45 +1,223 @@
+import gzip
 import os
+import time
 import unittest
 import json
-from flask_sqlalchemy import SQLAlchemy
+from copy import copy
+from flask import _app_ctx_stack, jsonify
+from sqlalchemy import create_engine, event, exc, orm, text
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.engine.url import make_url
 
+# offline runs (in-memory SQLite, locally minted tokens) need no settings,
+# app.py's module level app never connects to DATABASE_URL
+os.environ.setdefault('AUTH0_DOMAIN', 'agency-test.local')
+os.environ.setdefault('API_AUDIENCE', 'agency')
+os.environ.setdefault('DATABASE_URL', 'sqlite://')
+
+import auth
 from app import create_app
+from auth import (AuthError, JWKSCache, TokenCache, check_permissions,
+                  compile_permissions)
+from benchmarks.idp import IdentityProvider
+from benchmarks.run import compare, summarize
+from caching import CachedResponse, LRUCacheBackend, init_cache
+from dbpool import TimedQueuePool, engine_options, pool_status
+from instrumentation import Histogram
+from listing import encode_cursor
+from profiling import ProfileStore
+from replicas import ReplicaSet, RoutingSession
+from serialization import orjson
+from stats import _release_year_expression
 from models import *
 from datetime import date
 
 
+TEST_DATABASE_URL = os.environ.get('TEST_DATABASE_URL', 'sqlite://')
+ROLE_TOKENS = {
+    'casting_assistant': 'CASTING_ASSISTANT_TOKEN',
+    'casting_director': 'CASTING_DIRECTOR_TOKEN',
+    'executive_producer': 'EXECUTIVE_PRODUCER_TOKEN'
+}
+
+
+class LocalJWKSCache(JWKSCache):
+    """JWKSCache over the keys of a local identity provider"""
+
+    def __init__(self, jwks):
+        super().__init__('http://localhost/jwks.json')
+        self.jwks = jwks
+
+    def _fetch(self):
+        return {key['kid']: key for key in self.jwks['keys']}
+
+
+def role_tokens():
+    """the Auth0 tokens from the environment, or tokens for the same roles
+    minted by a local identity provider when they are not set"""
+    if all(name in os.environ for name in ROLE_TOKENS.values()):
+        return {role: os.environ[name] for role, name in ROLE_TOKENS.items()}
+
+    # a short key, generating it is most of the suite's startup time
+    provider = IdentityProvider(kid='test', bits=1024)
+    auth.jwks_cache = LocalJWKSCache(provider.jwks)
+    return {role: provider.mint(role) for role in ROLE_TOKENS}
+
+
+tokens = role_tokens()
 cast_assistant_header = {
-    'Authorization': 'Bearer {}'.format(
-        os.environ['CASTING_ASSISTANT_TOKEN'])}
+    'Authorization': 'Bearer {}'.format(tokens['casting_assistant'])}
 cast_director_header = {
-    'Authorization': 'Bearer {}'.format(
-        os.environ['CASTING_DIRECTOR_TOKEN'])}
+    'Authorization': 'Bearer {}'.format(tokens['casting_director'])}
 exec_producer_header = {
-    'Authorization': 'Bearer {}'.format(
-        os.environ['EXECUTIVE_PRODUCER_TOKEN'])}
+    'Authorization': 'Bearer {}'.format(tokens['executive_producer'])}
+
+
+def create_database(url):
+    """creates the Postgres database of url unless it exists"""
+    server = copy(url)
+    server.database = 'postgres'
+    engine = create_engine(server, isolation_level='AUTOCOMMIT')
+    try:
+        with engine.connect() as connection:
+            exists = connection.execute(
+                text('SELECT 1 FROM pg_database WHERE datname = :name'),
+                name=url.database).scalar()
+            if not exists:
+                connection.execute(f'CREATE DATABASE "{url.database}"')
+    finally:
+        engine.dispose()
+
+
+def worker_database_url(url):
+    """one database per pytest-xdist worker (<name>_gw0, <name>_gw1...)
+    in-memory SQLite is private to the process already"""
+    worker = os.environ.get('PYTEST_XDIST_WORKER')
+    parsed = make_url(url)
+    if not worker or parsed.database in (None, '', ':memory:'):
+        return url
+
+    if parsed.get_backend_name() == 'sqlite':
+        root, extension = os.path.splitext(parsed.database)
+        parsed.database = f'{root}_{worker}{extension}'
+    else:
+        parsed.database = f'{parsed.database}_{worker}'
+        if parsed.get_backend_name() in ('postgres', 'postgresql'):
+            create_database(parsed)
+    return str(parsed)
+
+
+class SavepointSession(RoutingSession):
+    """session bound to the test's connection: the app's commits and
+    rollbacks end a SAVEPOINT and open the next one, the test's own
+    transaction is never committed"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.begin_nested()
+
+    def commit(self):
+        super().commit()
+        # what a real commit does with expire_on_commit
+        self.expire_all()
+        self.begin_nested()
+
+    def rollback(self):
+        super().rollback()
+        self.begin_nested()
+
+    def close(self):
+        if self.transaction is not None and self.transaction.nested:
+            super().rollback()
+        super().close()
+
+
+class TransactionalDatabase:
+    """the schema is created once per test process, each test then runs
+    inside a transaction that is rolled back when it ends"""
+
+    def __init__(self, url):
+        self.url = url
+        self.app = None
+
+    def setup(self):
+        if self.app is not None:
+            return self.app
+
+        self.app = create_app({
+            'SQLALCHEMY_DATABASE_URI': worker_database_url(self.url),
+            'DB_STARTUP_MODE': 'none'
+        })
+        with self.app.app_context():
+            self.engine = db.get_engine(self.app)
+            if self.engine.dialect.name == 'sqlite':
+                # pysqlite opens transactions itself and breaks SAVEPOINT,
+                # let SQLAlchemy emit BEGIN instead
+                event.listen(self.engine, 'connect', _sqlite_autocommit)
+                event.listen(self.engine, 'begin', _sqlite_begin)
+            db.drop_all()
+            db.create_all()
+        return self.app
+
+    def begin(self):
+        self.connection = self.engine.connect()
+        self.transaction = self.connection.begin()
+        self.session = db.session
+        db.app = self.app
+        db.session = orm.scoped_session(
+            orm.sessionmaker(class_=SavepointSession, db=db,
+                             bind=self.connection, binds={}),
+            scopefunc=_app_ctx_stack.__ident_func__)
+
+    def rollback(self):
+        db.session.remove()
+        db.session = self.session
+        self.transaction.rollback()
+        self.connection.close()
+
+
+def _sqlite_autocommit(dbapi_connection, connection_record):
+    dbapi_connection.isolation_level = None
+
+
+def _sqlite_begin(connection):
+    connection.execute('BEGIN')
+
+
+transactional_database = TransactionalDatabase(TEST_DATABASE_URL)
 
 
 class AgencyTestCase(unittest.TestCase):
     """This class represents the casting agency test case"""
 
+    @classmethod
+    def setUpClass(cls):
+        cls.app = transactional_database.setup()
+
     def setUp(self):
-        """Define test variables and initialize app."""
-        self.app = create_app()
+        """Open the test's transaction and reset the app's state."""
         self.client = self.app.test_client
-        self.database_path = os.environ['TEST_DATABASE_URL']
-        setup_db(self.app, self.database_path)
-
-        # binds the app to the current context
-        with self.app.app_context():
-            self.db = SQLAlchemy()
-            self.db.init_app(self.app)
-            # create all tables
-            self.db.drop_all()
-            self.db.create_all()
+        self.config = dict(self.app.config)
+        init_cache(self.app)
+        transactional_database.begin()
 
     def tearDown(self):
-        """Executed after reach test"""
-        pass
+        """Roll back everything the test wrote"""
+        transactional_database.rollback()
+        self.app.config.clear()
+        self.app.config.update(self.config)
+
+    def seed(self):
+        """two actors and two movies, return their ids"""
+        actors = [Actor('Seed Actor', 40, 'Female'),
+                  Actor('Seed Actor', 50, 'Male')]
+        movies = [Movie('Seed Movie', date(2000, 1, 1)),
+                  Movie('Seed Movie', date(2010, 1, 1))]
+        with self.app.app_context():
+            db.session.add_all(actors + movies)
+            commit_write('actors', 'movies')
+            return ([actor.id for actor in actors],
+                    [movie.id for movie in movies])
 
     new_actor = {
         'name': 'Test Actor',
@@ -57,6 +235,7 @@ class AgencyTestCase(unittest.TestCase):
     """
 
     def test_get_actors(self):
+        self.seed()
         res = self.client().get('/actors', headers=cast_assistant_header)
         data = json.loads(res.data)
 
@@ -72,11 +251,201 @@ class AgencyTestCase(unittest.TestCase):
         self.assertEqual(data['success'], False)
         self.assertEqual(data['message'], 'Authorization header is expected.')
 
+    def test_get_actors_paginated(self):
+        for _ in range(3):
+            self.client().post(
+                '/actors',
+                json=self.new_actor,
+                headers=cast_director_header)
+        res = self.client().get(
+            '/actors?limit=2', headers=cast_assistant_header)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(data['actors']), 2)
+        self.assertTrue(data['next_cursor'])
+
+        res = self.client().get(
+            '/actors?limit=2&after={}'.format(data['next_cursor']),
+            headers=cast_assistant_header)
+        page = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(page['actors']), 1)
+        self.assertEqual(page['next_cursor'], None)
+        self.assertTrue(page['actors'][0]['id'] > data['actors'][1]['id'])
+
+    def test_400_get_actors_bad_cursor(self):
+        res = self.client().get(
+            '/actors?after=not-a-cursor', headers=cast_assistant_header)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['success'], False)
+        self.assertEqual(data['message'], 'bad request')
+
+    def test_400_get_actors_malformed_cursor(self):
+        for values in ({'id': True}, {'id': '1'}, {'id': 2 ** 40}, {}):
+            res = self.client().get(
+                f'/actors?after={encode_cursor(values)}',
+                headers=cast_assistant_header)
+            data = json.loads(res.data)
+
+            self.assertEqual(res.status_code, 400)
+            self.assertEqual(data['success'], False)
+
+    def test_stream_actors_ndjson(self):
+        self.client().post(
+            '/actors',
+            json=self.new_actor,
+            headers=cast_director_header)
+        res = self.client().get(
+            '/actors?stream=ndjson', headers=cast_assistant_header)
+        rows = [json.loads(line) for line in res.data.splitlines()]
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.mimetype, 'application/x-ndjson')
+        self.assertEqual(rows[0]['name'], self.new_actor['name'])
+
+    def test_get_actors_fields(self):
+        self.client().post(
+            '/actors',
+            json=self.new_actor,
+            headers=cast_director_header)
+        res = self.client().get(
+            '/actors?fields=name', headers=cast_assistant_header)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(set(data['actors'][0]), {'id', 'name'})
+
+    def test_400_get_actors_unknown_field(self):
+        res = self.client().get(
+            '/actors?fields=salary', headers=cast_assistant_header)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['success'], False)
+
+    def test_304_get_actors(self):
+        res = self.client().get('/actors', headers=cast_assistant_header)
+        etag = res.headers['ETag']
+
+        res = self.client().get('/actors', headers=dict(
+            cast_assistant_header, **{'If-None-Match': etag}))
+
+        self.assertEqual(res.status_code, 304)
+        self.assertEqual(res.data, b'')
+
+    def test_etag_changes_after_write(self):
+        res = self.client().get('/actors', headers=cast_assistant_header)
+        etag = res.headers['ETag']
+        self.client().post(
+            '/actors',
+            json=self.new_actor,
+            headers=cast_director_header)
+
+        res = self.client().get('/actors', headers=dict(
+            cast_assistant_header, **{'If-None-Match': etag}))
+
+        self.assertEqual(res.status_code, 200)
+        self.assertNotEqual(res.headers['ETag'], etag)
+
+    def test_get_actors_cache_hit(self):
+        self.client().get('/actors', headers=cast_assistant_header)
+        res = self.client().get('/actors', headers=cast_assistant_header)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.headers['X-Cache'], 'HIT')
+
+    def test_get_cache_stats(self):
+        res = self.client().get('/cache/stats', headers=cast_assistant_header)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertIn('hits', data['stats'])
+
+    def test_gzip_actors(self):
+        self.client().post('/actors', json=[self.new_actor] * 50,
+                           headers=cast_director_header)
+        headers = dict(cast_assistant_header, **{'Accept-Encoding': 'gzip'})
+        res = self.client().get('/actors', headers=headers)
+        data = json.loads(gzip.decompress(res.data))
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.headers['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', res.headers['Vary'])
+        self.assertEqual(len(data['actors']), 50)
+
+        res = self.client().get('/actors', headers=headers)
+        self.assertEqual(res.headers['X-Cache'], 'HIT')
+        self.assertEqual(len(json.loads(gzip.decompress(res.data))['actors']),
+                         50)
+
+    def test_small_response_not_compressed(self):
+        res = self.client().get(
+            '/actors', headers=dict(cast_assistant_header,
+                                    **{'Accept-Encoding': 'gzip'}))
+
+        self.assertEqual(res.status_code, 200)
+        self.assertNotIn('Content-Encoding', res.headers)
+
+    def test_get_actors_filtered_and_sorted(self):
+        self.client().post(
+            '/actors',
+            json=[dict(self.new_actor, age=age) for age in (25, 40, 35)],
+            headers=cast_director_header)
+        res = self.client().get(
+            '/actors?min_age=30&sort=-age', headers=cast_assistant_header)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([a['age'] for a in data['actors']], [40, 35])
+
+    def test_400_get_actors_bad_filter(self):
+        res = self.client().get(
+            '/actors?min_age=old', headers=cast_assistant_header)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['success'], False)
+
+    def test_400_get_actors_sort_with_extra_dashes(self):
+        for sort in ('--age', '---age'):
+            res = self.client().get(f'/actors?sort={sort}',
+                                    headers=cast_assistant_header)
+
+            self.assertEqual(res.status_code, 400)
+
+    def test_400_get_actors_filter_out_of_range(self):
+        res = self.client().get(
+            '/actors?min_age=99999999999999999999999',
+            headers=cast_assistant_header)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['success'], False)
+
+    def test_400_get_actors_cursor_value_not_scalar(self):
+        for value in ({'a': 1}, [1], 2 ** 40):
+            cursor = encode_cursor({'id': 1, 'sort': 'age', 'value': value})
+            res = self.client().get(f'/actors?sort=age&after={cursor}',
+                                    headers=cast_assistant_header)
+
+            self.assertEqual(res.status_code, 400)
+        cursor = encode_cursor({'id': 1, 'sort': 'name', 'value': {'a': 1}})
+        res = self.client().get(f'/actors?sort=name&after={cursor}',
+                                headers=cast_assistant_header)
+
+        self.assertEqual(res.status_code, 400)
+
     """
     GET test for /movies
     """
 
     def test_get_movies(self):
+        self.seed()
         res = self.client().get('/movies', headers=cast_assistant_header)
         data = json.loads(res.data)
 
@@ -92,6 +461,167 @@ class AgencyTestCase(unittest.TestCase):
         self.assertEqual(data['success'], False)
         self.assertEqual(data['message'], 'Authorization header is expected.')
 
+    """
+    GET test for /search
+    """
+
+    def test_search_prefix(self):
+        self.client().post(
+            '/actors',
+            json=[dict(self.new_actor, name=name)
+                  for name in ('Tom Hanks', 'Emma Stone')],
+            headers=cast_director_header)
+        res = self.client().get(
+            '/search?q=tom%20han', headers=cast_assistant_header)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([a['name'] for a in data['actors']], ['Tom Hanks'])
+
+    def test_400_search_without_query(self):
+        res = self.client().get('/search', headers=cast_assistant_header)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['success'], False)
+
+    def test_400_search_bad_cursor_offset(self):
+        for offset in (-5, True, '10', 2 ** 40):
+            cursor = encode_cursor({'actors': offset})
+            res = self.client().get(f'/search?q=tom&after={cursor}',
+                                    headers=cast_assistant_header)
+
+            self.assertEqual(res.status_code, 400)
+
+    """
+    GET / POST / DELETE test for /movies/<id>/actors
+    """
+
+    def _cast_movie(self):
+        res = self.client().post('/actors',
+                                 json=[self.new_actor, self.new_actor],
+                                 headers=cast_director_header)
+        actor_ids = [r['id'] for r in json.loads(res.data)['results']]
+        res = self.client().post('/movies', json=self.new_movie,
+                                 headers=exec_producer_header)
+        movie_id = json.loads(res.data)['movies'][0]['id']
+        res = self.client().post(
+            '/movies/{}/actors'.format(movie_id),
+            json={'actor_ids': actor_ids},
+            headers=cast_director_header)
+        return movie_id, actor_ids, res
+
+    def test_add_cast(self):
+        movie_id, actor_ids, res = self._cast_movie()
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['added'], actor_ids)
+
+        res = self.client().get('/movies/{}/actors'.format(movie_id),
+                                headers=cast_assistant_header)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([a['id'] for a in data['actors']], actor_ids)
+
+    def test_422_add_unknown_actor_to_cast(self):
+        res = self.client().post('/movies', json=self.new_movie,
+                                 headers=exec_producer_header)
+        movie_id = json.loads(res.data)['movies'][0]['id']
+        res = self.client().post(
+            '/movies/{}/actors'.format(movie_id), json={'actor_ids': [999]},
+            headers=cast_director_header)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual(data['success'], False)
+
+    def test_get_movies_embed_cast(self):
+        self._cast_movie()
+        res = self.client().get('/movies?embed=cast',
+                                headers=cast_assistant_header)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(data['movies'][0]['cast']), 2)
+
+    def test_remove_cast(self):
+        movie_id, actor_ids, _ = self._cast_movie()
+        res = self.client().delete(
+            '/movies/{}/actors/{}'.format(movie_id, actor_ids[0]),
+            headers=cast_director_header)
+        self.assertEqual(res.status_code, 200)
+
+        res = self.client().get('/actors/{}/movies'.format(actor_ids[0]),
+                                headers=cast_assistant_header)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['movies'], [])
+
+    def test_404_remove_uncast_actor_keeps_version(self):
+        movie_id, actor_ids, _ = self._cast_movie()
+        version = TableVersion.query.get('castings').version
+        res = self.client().delete(
+            '/movies/{}/actors/{}'.format(movie_id, actor_ids[-1] + 1),
+            headers=cast_director_header)
+
+        self.assertEqual(res.status_code, 404)
+        self.assertEqual(TableVersion.query.get('castings').version, version)
+
+    """
+    GET test for /stats
+    """
+
+    def test_get_stats(self):
+        self.client().post(
+            '/actors',
+            json=[dict(self.new_actor, age=age) for age in (25, 28, 41)],
+            headers=cast_director_header)
+        res = self.client().get('/stats', headers=cast_assistant_header)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['actors']['total'], 3)
+        self.assertEqual(data['actors']['by_age'][0],
+                         {'from': 20, 'to': 29, 'count': 2})
+        self.assertEqual(data['movies']['total'], 0)
+
+    def test_stats_summary_follows_writes(self):
+        self.app.config['STATS_SUMMARY'] = True
+        res = self.client().post('/actors', json=self.new_actor,
+                                 headers=cast_director_header)
+        actor_id = json.loads(res.data)['actors'][0]['id']
+        self.client().get('/stats', headers=cast_assistant_header)
+        self.client().patch('/actors/{}'.format(actor_id),
+                            json={'gender': 'Female'},
+                            headers=cast_director_header)
+        res = self.client().get('/stats?type=actors',
+                                headers=cast_assistant_header)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['source'], 'summary')
+        self.assertEqual(data['actors']['by_gender'],
+                         [{'gender': 'Female', 'count': 1}])
+
+    def test_stats_release_year_is_an_integer(self):
+        release_date = Movie.__table__.c.release_date
+        stmt = _release_year_expression(release_date)
+
+        self.assertEqual(
+            str(stmt.compile(dialect=postgresql.dialect())),
+            'CAST(EXTRACT(year FROM movies.release_date) AS INTEGER)')
+
+    def test_400_stats_bad_age_bucket(self):
+        res = self.client().get('/stats?age_bucket=0',
+                                headers=cast_assistant_header)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['success'], False)
+
     """
     POST test for /actors
     """
@@ -116,6 +646,39 @@ class AgencyTestCase(unittest.TestCase):
         self.assertEqual(data['success'], False)
         self.assertEqual(data['message'], 'Authorization header is expected.')
 
+    def test_create_actor_batch(self):
+        res = self.client().post(
+            '/actors',
+            json=[self.new_actor, self.new_actor],
+            headers=cast_director_header)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(len(data['actors']), 2)
+        self.assertEqual([r['index'] for r in data['results']], [0, 1])
+
+    def test_422_create_actor_batch(self):
+        res = self.client().post(
+            '/actors',
+            json=[self.new_actor, {'age': 30}],
+            headers=cast_director_header)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual(data['success'], False)
+        self.assertEqual(data['results'][0]['index'], 1)
+        self.assertEqual(Actor.query.count(), 0)
+
+    def test_422_create_actor_malformed_json(self):
+        res = self.client().post(
+            '/actors', data='{"name": ', content_type='application/json',
+            headers=cast_director_header)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual(data['success'], False)
+
     """
     POST test for /movies
     """
@@ -140,25 +703,37 @@ class AgencyTestCase(unittest.TestCase):
         self.assertEqual(data['success'], False)
         self.assertEqual(data['message'], 'Authorization header is expected.')
 
+    def test_422_create_movie_malformed_json(self):
+        res = self.client().post(
+            '/movies', data='[{"title"', content_type='application/json',
+            headers=exec_producer_header)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual(data['success'], False)
+
     """
     PATCH test for /actors/<id>
     """
 
     def test_update_actor_age(self):
+        actor_ids, _ = self.seed()
         res = self.client().patch(
-            '/actors/2',
+            '/actors/{}'.format(actor_ids[1]),
             json={
                 'age': 100},
             headers=cast_director_header)
         data = json.loads(res.data)
-        actor = Actor.query.filter(Actor.id == 2).one_or_none()
+        actor = Actor.query.filter(Actor.id == actor_ids[1]).one_or_none()
 
         self.assertEqual(res.status_code, 200)
         self.assertEqual(data['success'], True)
         self.assertEqual(actor.format()['age'], 100)
 
     def test_422_update_actor(self):
-        res = self.client().patch('/actors/2', headers=cast_director_header)
+        actor_ids, _ = self.seed()
+        res = self.client().patch('/actors/{}'.format(actor_ids[1]),
+                                  headers=cast_director_header)
         data = json.loads(res.data)
 
         self.assertEqual(res.status_code, 422)
@@ -182,20 +757,23 @@ class AgencyTestCase(unittest.TestCase):
     """
 
     def test_update_movie_title(self):
+        _, movie_ids = self.seed()
         res = self.client().patch(
-            '/movies/2',
+            '/movies/{}'.format(movie_ids[1]),
             json={
                 'title': 'Update Movie'},
             headers=cast_director_header)
         data = json.loads(res.data)
-        movie = Movie.query.filter(Movie.id == 2).one_or_none()
+        movie = Movie.query.filter(Movie.id == movie_ids[1]).one_or_none()
 
         self.assertEqual(res.status_code, 200)
         self.assertEqual(data['success'], True)
         self.assertEqual(movie.format()['title'], 'Update Movie')
 
     def test_422_update_movie(self):
-        res = self.client().patch('/movies/2', headers=cast_director_header)
+        _, movie_ids = self.seed()
+        res = self.client().patch('/movies/{}'.format(movie_ids[1]),
+                                  headers=cast_director_header)
         data = json.loads(res.data)
 
         self.assertEqual(res.status_code, 422)
@@ -214,23 +792,51 @@ class AgencyTestCase(unittest.TestCase):
         self.assertEqual(data['success'], False)
         self.assertEqual(data['message'], 'resource not found')
 
+    def test_update_actors_bulk(self):
+        res = self.client().post(
+            '/actors',
+            json=[self.new_actor, self.new_actor],
+            headers=cast_director_header)
+        ids = [r['id'] for r in json.loads(res.data)['results']]
+        res = self.client().patch(
+            '/actors',
+            json={'ids': ids, 'changes': {'age': 45}},
+            headers=cast_director_header)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['updated'], ids)
+        self.assertEqual(Actor.query.filter(Actor.age == 45).count(), 2)
+
+    def test_422_update_actors_bulk_without_target(self):
+        res = self.client().patch(
+            '/actors',
+            json={'changes': {'age': 45}},
+            headers=cast_director_header)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual(data['success'], False)
+
     """
     DELETE test for /actors
     """
 
     def test_delete_actor(self):
-        self.client().post(
+        res = self.client().post(
             '/actors',
             json=self.new_actor,
             headers=cast_director_header)
-        res = self.client().delete('/actors/1', headers=cast_director_header)
+        actor_id = json.loads(res.data)['actors'][0]['id']
+        res = self.client().delete('/actors/{}'.format(actor_id),
+                                   headers=cast_director_header)
         data = json.loads(res.data)
 
-        actor = Actor.query.filter(Actor.id == 1).one_or_none()
+        actor = Actor.query.filter(Actor.id == actor_id).one_or_none()
 
         self.assertEqual(res.status_code, 200)
         self.assertEqual(data['success'], True)
-        self.assertEqual(data['delete'], '1')
+        self.assertEqual(data['delete'], str(actor_id))
         self.assertEqual(actor, None)
 
     def test_422_delete_actor(self):
@@ -248,34 +854,54 @@ class AgencyTestCase(unittest.TestCase):
         self.assertEqual(data['message'], 'unprocessable')
 
     def test_403_delete_actor(self):
-        self.client().post(
+        res = self.client().post(
             '/actors',
             json=self.new_actor,
             headers=cast_director_header)
-        res = self.client().delete('/actors/1', headers=cast_assistant_header)
+        actor_id = json.loads(res.data)['actors'][0]['id']
+        res = self.client().delete('/actors/{}'.format(actor_id),
+                                   headers=cast_assistant_header)
         data = json.loads(res.data)
 
         self.assertEqual(res.status_code, 403)
         self.assertEqual(data['success'], False)
         self.assertEqual(data['message'], 'Permission not found.')
 
+    def test_delete_actors_bulk(self):
+        res = self.client().post(
+            '/actors',
+            json=[self.new_actor, self.new_actor],
+            headers=cast_director_header)
+        ids = [r['id'] for r in json.loads(res.data)['results']]
+        res = self.client().delete(
+            '/actors',
+            json={'ids': ids},
+            headers=cast_director_header)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['deleted'], ids)
+        self.assertEqual(Actor.query.count(), 0)
+
     """
     DELETE test for /movies
     """
 
     def test_delete_movie(self):
-        self.client().post(
+        res = self.client().post(
             '/movies',
             json=self.new_movie,
             headers=exec_producer_header)
-        res = self.client().delete('/movies/1', headers=exec_producer_header)
+        movie_id = json.loads(res.data)['movies'][0]['id']
+        res = self.client().delete('/movies/{}'.format(movie_id),
+                                   headers=exec_producer_header)
         data = json.loads(res.data)
 
-        movie = Movie.query.filter(Movie.id == 1).one_or_none()
+        movie = Movie.query.filter(Movie.id == movie_id).one_or_none()
 
         self.assertEqual(res.status_code, 200)
         self.assertEqual(data['success'], True)
-        self.assertEqual(data['delete'], '1')
+        self.assertEqual(data['delete'], str(movie_id))
         self.assertEqual(movie, None)
 
     def test_422_delete_movie(self):
@@ -293,11 +919,13 @@ class AgencyTestCase(unittest.TestCase):
         self.assertEqual(data['message'], 'unprocessable')
 
     def test_403_delete_movie(self):
-        self.client().post(
+        res = self.client().post(
             '/movies',
             json=self.new_movie,
             headers=exec_producer_header)
-        res = self.client().delete('/movies/1', headers=cast_director_header)
+        movie_id = json.loads(res.data)['movies'][0]['id']
+        res = self.client().delete('/movies/{}'.format(movie_id),
+                                   headers=cast_director_header)
         data = json.loads(res.data)
 
         self.assertEqual(res.status_code, 403)
@@ -305,6 +933,364 @@ class AgencyTestCase(unittest.TestCase):
         self.assertEqual(data['message'], 'Permission not found.')
 
 
+class FakeJWKSCache(JWKSCache):
+    """JWKSCache that serves keys from memory and counts fetches"""
+
+    def __init__(self, kids, **kwargs):
+        super().__init__('http://localhost/jwks.json', **kwargs)
+        self.kids = kids
+        self.fetches = 0
+
+    def _fetch(self):
+        self.fetches += 1
+        if self.kids is None:
+            raise OSError('identity provider unavailable')
+        return {kid: {'kid': kid} for kid in self.kids}
+
+
+class JWKSCacheTestCase(unittest.TestCase):
+    """This class represents the JWKS key store test case"""
+
+    def test_keys_are_cached(self):
+        cache = FakeJWKSCache(['a'], ttl=60)
+        for _ in range(10):
+            self.assertEqual(cache.get_key('a')['kid'], 'a')
+
+        self.assertEqual(cache.fetches, 1)
+
+    def test_unknown_kid_refetches_once(self):
+        cache = FakeJWKSCache(['a'], ttl=60, miss_interval=60)
+        cache.get_key('a')
+        cache.kids = ['a', 'b']
+
+        self.assertEqual(cache.get_key('b')['kid'], 'b')
+        self.assertEqual(cache.get_key('c'), None)
+        self.assertEqual(cache.fetches, 2)
+
+    def test_cold_cache_unknown_kid_fetches_once(self):
+        cache = FakeJWKSCache(['a'], ttl=60, miss_interval=0)
+
+        self.assertEqual(cache.get_key('b'), None)
+        self.assertEqual(cache.fetches, 1)
+
+    def test_failed_refresh_backs_off(self):
+        cache = FakeJWKSCache(['a'], ttl=0, retry_interval=60)
+        cache.get_key('a')
+        cache.kids = None
+
+        for _ in range(5):
+            self.assertEqual(cache.get_key('a')['kid'], 'a')
+        self.assertEqual(cache.get_key('b'), None)
+        self.assertEqual(cache.fetches, 2)
+
+    def test_refresh_retried_after_backoff(self):
+        cache = FakeJWKSCache(['a'], ttl=0, retry_interval=0)
+        cache.get_key('a')
+        cache.kids = None
+        cache.get_key('a')
+        cache.kids = ['a', 'b']
+
+        self.assertEqual(cache.get_key('b')['kid'], 'b')
+        self.assertEqual(cache.fetches, 3)
+
+    def test_expired_keys_are_refetched(self):
+        cache = FakeJWKSCache(['a'], ttl=0)
+        cache.get_key('a')
+        cache.get_key('a')
+
+        self.assertEqual(cache.fetches, 2)
+
+
+class TokenCacheTestCase(unittest.TestCase):
+    """This class represents the verified token cache test case"""
+
+    def test_cached_payload_is_returned(self):
+        cache = TokenCache(maxsize=2)
+        claims = ({'exp': time.time() + 60}, frozenset())
+        cache.put('token', claims)
+
+        self.assertIs(cache.get('token'), claims)
+
+    def test_expired_token_is_evicted(self):
+        cache = TokenCache(maxsize=2)
+        cache.put('token', ({'exp': time.time() - 1}, frozenset()))
+
+        self.assertEqual(cache.get('token'), None)
+        self.assertEqual(len(cache), 0)
+
+    def test_least_recently_used_is_evicted(self):
+        cache = TokenCache(maxsize=2)
+        exp = time.time() + 60
+        cache.put('a', ({'exp': exp}, frozenset()))
+        cache.put('b', ({'exp': exp}, frozenset()))
+        cache.get('a')
+        cache.put('c', ({'exp': exp}, frozenset()))
+
+        self.assertEqual(cache.get('b'), None)
+        self.assertTrue(cache.get('a'))
+        self.assertTrue(cache.get('c'))
+
+
+class PermissionsTestCase(unittest.TestCase):
+    """This class represents the compiled permission checks test case"""
+
+    payload = {'permissions': ['get:actors', 'get:movies']}
+
+    def test_single_permission(self):
+        self.assertTrue(check_permissions('get:actors', self.payload))
+
+        with self.assertRaises(AuthError) as ctx:
+            check_permissions('post:actors', self.payload)
+        self.assertEqual(ctx.exception.status_code, 403)
+
+    def test_any_of(self):
+        required = compile_permissions(any_of=['post:actors', 'get:movies'])
+
+        self.assertTrue(check_permissions(required, self.payload))
+
+    def test_all_of(self):
+        required = compile_permissions(all_of=['get:actors', 'post:actors'])
+
+        with self.assertRaises(AuthError) as ctx:
+            check_permissions(required, self.payload)
+        self.assertEqual(ctx.exception.status_code, 403)
+
+    def test_missing_permissions_claim(self):
+        with self.assertRaises(AuthError) as ctx:
+            check_permissions('get:actors', {})
+        self.assertEqual(ctx.exception.status_code, 401)
+
+
+class LRUCacheBackendTestCase(unittest.TestCase):
+    """This class represents the in-process response cache test case"""
+
+    def test_invalidate_drops_tagged_entries(self):
+        backend = LRUCacheBackend(max_entries=10, max_bytes=1024)
+        backend.set('a', CachedResponse(b'{}', 'application/json'),
+                    ('actors',))
+        backend.set('m', CachedResponse(b'{}', 'application/json'),
+                    ('movies',))
+        backend.invalidate('actors')
+
+        self.assertEqual(backend.get('a'), None)
+        self.assertTrue(backend.get('m'))
+
+    def test_byte_limit_evicts_oldest(self):
+        backend = LRUCacheBackend(max_entries=10, max_bytes=8)
+        backend.set('a', CachedResponse(b'12345', 'text/plain'), ())
+        backend.set('b', CachedResponse(b'12345', 'text/plain'), ())
+
+        self.assertEqual(backend.get('a'), None)
+        self.assertEqual(backend.size, 5)
+
+
+class TimedQueuePoolTestCase(unittest.TestCase):
+    """Checkout counters of the connection pool"""
+
+    def setUp(self):
+        self.engine = create_engine(
+            'sqlite://', poolclass=TimedQueuePool, pool_size=1,
+            max_overflow=0, pool_timeout=0.05)
+
+    def tearDown(self):
+        self.engine.dispose()
+
+    def test_counts_checkouts_and_timeouts(self):
+        connection = self.engine.connect()
+        with self.assertRaises(exc.TimeoutError):
+            self.engine.connect()
+        connection.close()
+        status = pool_status(self.engine.pool)
+
+        self.assertEqual(status['checkouts'], 1)
+        self.assertEqual(status['timeouts'], 1)
+        self.assertGreaterEqual(status['wait_seconds_max'], 0.05)
+
+    def test_sqlite_keeps_default_pool(self):
+        app = type('App', (), {'config': {}})
+
+        self.assertEqual(engine_options(app, 'sqlite:///agency.db'),
+                         {'pool_pre_ping': True})
+        self.assertEqual(
+            engine_options(app, 'postgresql://localhost/agency')['poolclass'],
+            TimedQueuePool)
+
+
+class ReplicaSetTestCase(unittest.TestCase):
+    """Round robin and failover of the read replicas"""
+
+    def test_round_robin(self):
+        replicas = ReplicaSet(['r1', 'r2'])
+
+        self.assertEqual([replicas.choose() for _ in range(3)],
+                         ['r1', 'r2', 'r1'])
+
+    def test_skips_replica_marked_down(self):
+        replicas = ReplicaSet(['r1', 'r2'], retry_after=60)
+        replicas.mark_down('r1')
+
+        self.assertEqual([replicas.choose() for _ in range(2)],
+                         ['r2', 'r2'])
+        self.assertFalse(replicas.healthy('r1'))
+
+    def test_all_down_falls_back_to_primary(self):
+        replicas = ReplicaSet(['r1'], retry_after=60)
+        replicas.mark_down('r1')
+
+        self.assertIsNone(replicas.choose())
+
+    def test_replica_retried_after_window(self):
+        replicas = ReplicaSet(['r1'], retry_after=0)
+        replicas.mark_down('r1')
+
+        self.assertEqual(replicas.choose(), 'r1')
+
+
+class StartupTestCase(unittest.TestCase):
+    """Schema handling when the app starts"""
+
+    def test_verify_schema_rejects_unmigrated_database(self):
+        app = create_app({'SQLALCHEMY_DATABASE_URI': 'sqlite://',
+                          'DB_STARTUP_MODE': 'none'})
+        with app.app_context():
+            with self.assertRaises(RuntimeError):
+                verify_schema()
+
+    def test_unknown_startup_mode(self):
+        with self.assertRaises(ValueError):
+            create_app({'SQLALCHEMY_DATABASE_URI': 'sqlite://',
+                        'DB_STARTUP_MODE': 'sometimes'})
+
+
+class HistogramTestCase(unittest.TestCase):
+    """Prometheus text rendering of the request histograms"""
+
+    def test_buckets_are_cumulative(self):
+        histogram = Histogram('latency', 'Latency.', ('route',), (0.1, 1.0))
+        histogram.observe(('/actors',), 0.05)
+        histogram.observe(('/actors',), 0.5)
+        lines = histogram.render()
+
+        self.assertIn('latency_bucket{route="/actors",le="0.1"} 1', lines)
+        self.assertIn('latency_bucket{route="/actors",le="1.0"} 2', lines)
+        self.assertIn('latency_bucket{route="/actors",le="+Inf"} 2', lines)
+        self.assertIn('latency_count{route="/actors"} 2', lines)
+
+    def test_server_timing_header(self):
+        app = create_app({'SQLALCHEMY_DATABASE_URI': 'sqlite://',
+                          'DB_STARTUP_MODE': 'none'})
+        res = app.test_client().get('/actors')
+
+        self.assertEqual(res.status_code, 401)
+        self.assertIn('total;dur=', res.headers['Server-Timing'])
+
+    def test_metrics_need_metrics_permission(self):
+        app = create_app({'SQLALCHEMY_DATABASE_URI': 'sqlite://',
+                          'DB_STARTUP_MODE': 'none'})
+        res = app.test_client().get('/metrics', headers=cast_assistant_header)
+        self.assertEqual(res.status_code, 403)
+
+        app = create_app({'SQLALCHEMY_DATABASE_URI': 'sqlite://',
+                          'DB_STARTUP_MODE': 'none',
+                          'METRICS_PERMISSION': 'get:movies'})
+        res = app.test_client().get('/metrics', headers=cast_assistant_header)
+        self.assertEqual(res.status_code, 200)
+        self.assertIn(b'http_request_duration_seconds', res.data)
+
+
+class ProfileStoreTestCase(unittest.TestCase):
+    """the profiler keeps the slowest requests of the worker"""
+
+    def test_keeps_the_slowest(self):
+        store = ProfileStore(keep=2)
+        ids = [store.add({'duration_ms': ms}, None) for ms in (30, 10, 20)]
+
+        self.assertEqual([entry['duration_ms'] for entry in store.entries()],
+                         [30, 20])
+        self.assertIsNone(store.get(ids[1]))
+        self.assertEqual(store.get(ids[2])[0]['duration_ms'], 20)
+
+    def test_profiled_on_token_header(self):
+        app = create_app({'SQLALCHEMY_DATABASE_URI': 'sqlite://',
+                          'DB_STARTUP_MODE': 'none',
+                          'PROFILE_TOKEN': 'secret'})
+        client = app.test_client()
+
+        self.assertNotIn('X-Profile-Id', client.get('/actors').headers)
+        res = client.get('/actors', headers={'X-Profile': 'secret'})
+        self.assertEqual(res.status_code, 401)
+        self.assertEqual(res.headers['X-Profile-Id'], '1')
+
+    def test_config_needs_admin_permission(self):
+        app = create_app({'SQLALCHEMY_DATABASE_URI': 'sqlite://',
+                          'DB_STARTUP_MODE': 'none',
+                          'PROFILE_PERMISSION': 'get:actors'})
+        client = app.test_client()
+
+        res = client.get('/debug/profiles', headers=cast_assistant_header)
+        self.assertEqual(res.status_code, 200)
+        res = client.patch('/debug/profiles/config', json={'enabled': True},
+                           headers=cast_assistant_header)
+        self.assertEqual(res.status_code, 403)
+        self.assertFalse(app.config['PROFILE_ENABLED'])
+
+
+class BenchmarkGateTestCase(unittest.TestCase):
+    """benchmark results are gated on a baseline run"""
+
+    def test_percentiles_are_nearest_rank(self):
+        report = summarize([i / 1000 for i in range(1, 101)], 0, 2.0)
+
+        self.assertEqual(report['p50_ms'], 50)
+        self.assertEqual(report['p99_ms'], 99)
+        self.assertEqual(report['rps'], 50)
+
+    def test_regressions_beyond_tolerance(self):
+        baseline = {'scenarios': {'list': summarize([0.010] * 10, 0, 1.0)}}
+        slower = {'scenarios': {'list': summarize([0.011] * 10, 0, 1.0)}}
+        much_slower = {'scenarios': {'list': summarize([0.020] * 5, 1, 1.0)}}
+
+        self.assertEqual(compare(slower, baseline, 0.15), [])
+        self.assertEqual(len(compare(much_slower, baseline, 0.15)), 5)
+
+
+class SerializationTestCase(unittest.TestCase):
+    """responses encode the same with either json backend"""
+
+    body = {'movies': [{'id': 1, 'title': 'Test Movie',
+                        'release_date': date(2020, 7, 30)}]}
+
+    def encode(self, backend, body):
+        app = create_app({'SQLALCHEMY_DATABASE_URI': 'sqlite://',
+                          'DB_STARTUP_MODE': 'none',
+                          'JSON_BACKEND': backend})
+        with app.test_request_context():
+            return app.config['JSON_BACKEND'], \
+                json.loads(jsonify(body).get_data())
+
+    def test_dates_are_iso(self):
+        backend, data = self.encode('stdlib', self.body)
+
+        self.assertEqual(backend, 'stdlib')
+        self.assertEqual(data['movies'][0]['release_date'], '2020-07-30')
+
+    @unittest.skipIf(orjson is None, 'orjson is not installed')
+    def test_orjson_matches_stdlib(self):
+        backend, data = self.encode('auto', self.body)
+
+        self.assertEqual(backend, 'orjson')
+        self.assertEqual(data, self.encode('stdlib', self.body)[1])
+
+    def test_orjson_falls_back_on_big_integers(self):
+        _, data = self.encode('auto', {'id': 2 ** 70})
+
+        self.assertEqual(data['id'], 2 ** 70)
+
+    def test_unknown_backend(self):
+        with self.assertRaises(ValueError):
+            self.encode('simplejson', {})
+
+
 # Make the tests conveniently executable
 if __name__ == "__main__":
     unittest.main()